@@ -0,0 +1,62 @@
+"""Compare gzip decompression backends.
+
+Each available backend is used to read a gzip compressed file line by line,
+as the multiplexing reader does. If a file is not provided, a synthetic
+FASTQ is generated.
+
+$ python benchmarks/decompression.py [--path reads.fastq.gz]
+"""
+import os
+import time
+import random
+import tempfile
+
+import click
+
+from mxdx._io import IO
+from mxdx._codec import available_gzip_backends
+
+
+def _synthetic_fastq(path, n_records):
+    import gzip
+    rng = random.Random(42)
+    with gzip.open(path, 'wt') as fp:
+        for i in range(n_records):
+            seq = ''.join(rng.choice('ACGT') for _ in range(150))
+            qual = ''.join(rng.choice('#FGHIJ') for _ in range(150))
+            fp.write(f"@r{i}\n{seq}\n+\n{qual}\n")
+
+
+@click.command()
+@click.option('--path', type=click.Path(exists=True), required=False,
+              help="A gzip compressed file to read")
+@click.option('--n-records', type=int, default=200000,
+              help="Records to generate if a path is not provided")
+@click.option('--repeats', type=int, default=3,
+              help="Number of times to read the file with each backend")
+def main(path, n_records, repeats):
+    """Time reading a gzip compressed file with each backend."""
+    with tempfile.TemporaryDirectory() as tmpdir:
+        if path is None:
+            path = os.path.join(tmpdir, 'synthetic.fastq.gz')
+            _synthetic_fastq(path, n_records)
+
+        size = os.path.getsize(path)
+        click.echo(f"{path}: {size / 1024 ** 2:.1f} MiB compressed")
+        click.echo("backend\tbest_seconds\tcompressed_MiB_per_second")
+        for backend in available_gzip_backends():
+            times = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                with IO.open_input(path, gzip_backend=backend) as fp:
+                    for _ in fp:
+                        pass
+                times.append(time.perf_counter() - start)
+
+            best = min(times)
+            click.echo(f"{backend}\t{best:.3f}\t"
+                       f"{size / 1024 ** 2 / best:.1f}")
+
+
+if __name__ == '__main__':
+    main()
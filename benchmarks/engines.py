@@ -0,0 +1,88 @@
+"""Compare the process and thread engines.
+
+A synthetic paired FASTQ file map is multiplexed to a file, and the result
+demultiplexed, with each engine and batch size. Small batches show the
+fixed cost of starting processes, large batches the cost of sharing the GIL.
+
+$ python benchmarks/engines.py [--compression gz]
+"""
+import os
+import time
+import random
+import tempfile
+
+import click
+
+from mxdx._io import FileMap
+from mxdx._mxdx import Multiplex, Demultiplex
+from mxdx._constants import PROCESSES, THREADS, SEQUENTIAL, SEPARATE
+
+
+def _synthetic_file_map(tmpdir, n_files, n_records):
+    rng = random.Random(42)
+    rows = ["filename_1\tfilename_2\trecord_count"]
+    for i in range(n_files):
+        paths = []
+        for orientation in (1, 2):
+            path = os.path.join(tmpdir, f"s{i}_R{orientation}.fastq")
+            with open(path, 'w') as fp:
+                for j in range(n_records):
+                    seq = ''.join(rng.choice('ACGT') for _ in range(150))
+                    fp.write(f"@s{i}r{j}\n{seq}\n+\n{'F' * 150}\n")
+            paths.append(path)
+        rows.append(f"{paths[0]}\t{paths[1]}\t{n_records}")
+
+    path = os.path.join(tmpdir, 'file-map.tsv')
+    with open(path, 'w') as fp:
+        fp.write('\n'.join(rows) + '\n')
+    return path
+
+
+def _best(f, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+@click.command()
+@click.option('--n-files', type=int, default=4,
+              help="Number of paired files to generate")
+@click.option('--n-records', type=int, default=100000,
+              help="Records to generate per file")
+@click.option('--batch-sizes', type=str, default='1000,400000',
+              help="Comma separated batch sizes to time")
+@click.option('--compression', type=click.Choice(['none', 'gz']),
+              default='none', help="How to compress the demultiplexed files")
+@click.option('--repeats', type=int, default=3,
+              help="Number of times to run each configuration")
+def main(n_files, n_records, batch_sizes, compression, repeats):
+    """Time mux and demux of a batch with each engine."""
+    extension = 'fastq' if compression == 'none' else 'fastq.gz'
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fm_path = _synthetic_file_map(tmpdir, n_files, n_records)
+
+        click.echo("engine\tbatch_size\tmux_seconds\tdemux_seconds")
+        for batch_size in [int(b) for b in batch_sizes.split(',')]:
+            fm = FileMap.from_tsv(fm_path, batch_size)
+            mux_path = os.path.join(tmpdir, 'mux.fastq')
+            for engine in (PROCESSES, THREADS):
+                def mux():
+                    Multiplex(fm, 0, SEQUENTIAL, mux_path,
+                              engine=engine).start()
+
+                def demux():
+                    output_base = tempfile.mkdtemp(dir=tmpdir)
+                    Demultiplex(fm, 0, SEPARATE, mux_path, output_base,
+                                extension, engine=engine).start()
+
+                mux_time = _best(mux, repeats)
+                demux_time = _best(demux, repeats)
+                click.echo(f"{engine}\t{batch_size}\t{mux_time:.3f}\t"
+                           f"{demux_time:.3f}")
+
+
+if __name__ == '__main__':
+    main()
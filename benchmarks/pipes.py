@@ -0,0 +1,81 @@
+"""Compare pipe sizes, and direct or buffered writes, over a mux | demux.
+
+A synthetic paired FASTQ file map is multiplexed to stdout and piped into
+a demultiplex, or into a consumer which discards what it reads, with each
+combination of --pipe-size-mb and --direct-write/--buffered-write.
+
+$ python benchmarks/pipes.py [--consumer cat]
+"""
+import os
+import time
+import random
+import subprocess
+import tempfile
+
+import click
+
+
+def _synthetic_file_map(tmpdir, n_files, n_records):
+    rng = random.Random(42)
+    rows = ["filename_1\tfilename_2\trecord_count"]
+    for i in range(n_files):
+        paths = []
+        for orientation in (1, 2):
+            path = os.path.join(tmpdir, f"s{i}_R{orientation}.fastq")
+            with open(path, 'w') as fp:
+                for j in range(n_records):
+                    seq = ''.join(rng.choice('ACGT') for _ in range(150))
+                    fp.write(f"@s{i}r{j}\n{seq}\n+\n{'F' * 150}\n")
+            paths.append(path)
+        rows.append(f"{paths[0]}\t{paths[1]}\t{n_records}")
+
+    path = os.path.join(tmpdir, 'file-map.tsv')
+    with open(path, 'w') as fp:
+        fp.write('\n'.join(rows) + '\n')
+    return path
+
+
+def _best(cmd, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run(cmd, shell=True, check=True)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+@click.command()
+@click.option('--n-files', type=int, default=4,
+              help="Number of paired files to generate")
+@click.option('--n-records', type=int, default=100000,
+              help="Records to generate per file")
+@click.option('--pipe-sizes', type=str, default='0,1',
+              help="Comma separated pipe sizes in megabytes to time")
+@click.option('--consumer', type=click.Choice(['demux', 'cat']),
+              default='demux', help="What reads the multiplexed stream")
+@click.option('--repeats', type=int, default=3,
+              help="Number of times to run each configuration")
+def main(n_files, n_records, pipe_sizes, consumer, repeats):
+    """Time a piped mux with each pipe configuration."""
+    batch_size = n_files * n_records
+    with tempfile.TemporaryDirectory() as tmpdir:
+        fm_path = _synthetic_file_map(tmpdir, n_files, n_records)
+        common = f"--file-map {fm_path} --batch 0 --batch-size {batch_size}"
+
+        click.echo("pipe_size_mb\twrite\tseconds")
+        for pipe_size in [int(p) for p in pipe_sizes.split(',')]:
+            for write in ('direct-write', 'buffered-write'):
+                mux = f"mxdx mux {common} --pipe-size-mb {pipe_size} --{write}"
+                if consumer == 'cat':
+                    sink = "cat > /dev/null"
+                else:
+                    output_base = tempfile.mkdtemp(dir=tmpdir)
+                    sink = (f"mxdx demux {common} --pipe-size-mb {pipe_size} "
+                            f"--output-base {output_base} --extension fastq")
+
+                seconds = _best(f"{mux} | {sink}", repeats)
+                click.echo(f"{pipe_size}\t{write}\t{seconds:.3f}")
+
+
+if __name__ == '__main__':
+    main()
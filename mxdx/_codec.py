@@ -0,0 +1,541 @@
+"""Selectable backends for gzip decompression, and output compression."""
+import os
+import io
+import bz2
+import gzip
+import lzma
+import zlib
+import struct
+import mimetypes
+import queue
+import shutil
+import threading
+import subprocess
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from importlib.util import find_spec
+
+GZIP_BACKEND_ENV = 'MXDX_GZIP_BACKEND'
+AUTO = 'auto'
+
+
+def _open_isal(raw):
+    from isal import igzip
+    return igzip.IGzipFile(fileobj=raw, mode='rb')
+
+
+def _open_zlib_ng(raw):
+    from zlib_ng import gzip_ng
+    return gzip_ng.GzipNGFile(fileobj=raw, mode='rb')
+
+
+def _open_rapidgzip(raw, threads=None):
+    import rapidgzip
+    if threads is None:
+        threads = available_cores()
+    return io.BufferedReader(
+        rapidgzip.RapidgzipFile(raw, parallelization=threads))
+
+
+def _open_python(raw):
+    return gzip.GzipFile(fileobj=raw, mode='rb')
+
+
+def _piped(program):
+    def opener(raw):
+        cmd = [shutil.which(program), '-dc']
+        return io.BufferedReader(_PipedDecompressor(cmd, raw))
+    return opener
+
+
+class _PipedDecompressor(io.RawIOBase):
+    """Decompress through an external program.
+
+    The program reads the file directly, and runs in its own process, so
+    decompression is taken out of the reading process entirely.
+    """
+
+    def __init__(self, cmd, raw):
+        # the file may have been peeked, and a buffered seek need not move
+        # the descriptor, so rewind it directly for the program to see all
+        os.lseek(raw.fileno(), 0, os.SEEK_SET)
+        self._cmd = cmd
+        self._proc = subprocess.Popen(cmd, stdin=raw, stdout=subprocess.PIPE)
+        raw.close()
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self._proc.stdout.readinto(b)
+        if n == 0 and self._proc.wait() != 0:
+            raise IOError(f"{self._cmd[0]} exited with "
+                          f"{self._proc.returncode}")
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._proc.stdout.close()
+
+            # we may not have consumed everything, which is fine
+            if self._proc.poll() is None:
+                self._proc.terminate()
+            self._proc.wait()
+        super().close()
+
+
+def available_cores():
+    """Determine the cores we may use, respecting affinity such as SLURM's."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+# parallel backends are only automatically selected with more than one core
+GzipBackend = namedtuple('GzipBackend', 'available open parallel')
+
+# ordered by preference for automatic selection
+GZIP_BACKENDS = {
+    'rapidgzip': GzipBackend(lambda: find_spec('rapidgzip') is not None,
+                             _open_rapidgzip, True),
+    'isal': GzipBackend(lambda: find_spec('isal') is not None,
+                        _open_isal, False),
+    'zlib-ng': GzipBackend(lambda: find_spec('zlib_ng') is not None,
+                           _open_zlib_ng, False),
+    'igzip': GzipBackend(lambda: shutil.which('igzip') is not None,
+                         _piped('igzip'), False),
+    'pigz': GzipBackend(lambda: shutil.which('pigz') is not None,
+                        _piped('pigz'), False),
+    'python': GzipBackend(lambda: True, _open_python, False),
+}
+
+
+def available_gzip_backends():
+    """List the usable gzip backends in order of preference."""
+    return [name for name, backend in GZIP_BACKENDS.items()
+            if backend.available()]
+
+
+def resolve_gzip_backend(name=None):
+    """Determine the gzip backend to use.
+
+    If a name is not provided, the MXDX_GZIP_BACKEND environment variable is
+    consulted, and otherwise the most preferred available backend is used.
+    """
+    if name is None:
+        name = os.environ.get(GZIP_BACKEND_ENV, AUTO)
+
+    if name == AUTO:
+        parallel_ok = available_cores() > 1
+        for candidate in available_gzip_backends():
+            if parallel_ok or not GZIP_BACKENDS[candidate].parallel:
+                return candidate
+
+    if name not in GZIP_BACKENDS:
+        raise ValueError(f"Unknown gzip backend: {name}")
+
+    if not GZIP_BACKENDS[name].available():
+        raise ValueError(f"gzip backend is not available: {name}")
+
+    return name
+
+
+def open_gzip(raw, backend=None, threads=None):
+    """Decompress a binary file handle with a gzip backend.
+
+    A parallel backend decompresses with the threads given, by default one
+    per available core.
+    """
+    backend = GZIP_BACKENDS[resolve_gzip_backend(backend)]
+    if backend.parallel and threads is not None:
+        return backend.open(raw, threads)
+    return backend.open(raw)
+
+
+class ReadAhead(io.RawIOBase):
+    """Read a binary stream ahead of its consumer in a background thread.
+
+    Decompressors release the GIL while inflating a block, so a stream read
+    ahead in a thread decompresses concurrently with whatever the consumer
+    is doing, such as parsing records or decompressing a mate file.
+    """
+
+    BLOCKSIZE = 1024 * 1024
+    MAXBLOCKS = 8
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._queue = queue.Queue(maxsize=self.MAXBLOCKS)
+        self._stop = threading.Event()
+        self._block = memoryview(b'')
+        self._eof = False
+
+        # the thread does not reference us, so if we are discarded without
+        # being closed, we are still collected and the thread told to stop
+        self._thread = threading.Thread(target=self._run,
+                                        args=(stream, self._queue,
+                                              self._stop, self.BLOCKSIZE),
+                                        daemon=True)
+        self._thread.start()
+
+    @staticmethod
+    def _run(stream, blocks, stop, blocksize):
+        def put(item):
+            # do not block forever if our consumer went away
+            while not stop.is_set():
+                try:
+                    blocks.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    continue
+
+        try:
+            while not stop.is_set():
+                block = stream.read(blocksize)
+                put(block)
+                if not block:
+                    break
+        except Exception as e:
+            # surface the problem to the consumer
+            put(e)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if len(self._block) == 0 and not self._eof:
+            item = self._queue.get()
+            if isinstance(item, Exception):
+                raise item
+            elif not item:
+                self._eof = True
+            else:
+                self._block = memoryview(item)
+
+        if self._eof:
+            return 0
+
+        n = min(len(b), len(self._block))
+        b[:n] = self._block[:n]
+        self._block = self._block[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._stop.set()
+            self._thread.join()
+            self._stream.close()
+        super().close()
+
+
+# stdlib defaults, which we retain so outputs do not change by default
+DEFAULT_LEVELS = {'gzip': 9, 'xz': 6, 'bzip2': 9, 'lz4': 0, 'zstd': 3}
+
+# compressions mimetypes does not know about, and the module they require
+EXTENSION_COMPRESSIONS = {'lz4': 'lz4', 'zst': 'zstd'}
+COMPRESSION_MODULES = {'lz4': 'lz4', 'zstd': 'zstandard'}
+
+# the zstd command line default
+ZSTD_DICT_SIZE = 112640
+
+
+def compression_from_extension(extension):
+    """Determine the compression implied by a file extension."""
+    _, encoding = mimetypes.guess_type(f"file.{extension.lstrip('.')}")
+    if encoding in ('gzip', 'xz', 'bzip2'):
+        return encoding
+
+    suffix = extension.rsplit('.', 1)[-1]
+    return EXTENSION_COMPRESSIONS.get(suffix)
+
+
+def open_lz4(raw):
+    """Decompress a binary handle of one or more lz4 frames."""
+    import lz4.frame
+    return lz4.frame.LZ4FrameFile(raw, mode='rb')
+
+
+def open_zstd(raw, dict_data=None):
+    """Decompress a binary handle of one or more zstd frames.
+
+    Outputs compressed with a dictionary require the same dictionary.
+    """
+    import zstandard
+    if dict_data is not None:
+        dict_data = zstandard.ZstdCompressionDict(dict_data)
+    dctx = zstandard.ZstdDecompressor(dict_data=dict_data)
+    return io.BufferedReader(dctx.stream_reader(raw, read_across_frames=True,
+                                                closefd=False))
+
+
+def train_zstd_dict(samples, size=ZSTD_DICT_SIZE):
+    """Train a zstd dictionary from an iterable of bytes samples."""
+    import zstandard
+    return zstandard.train_dictionary(size, list(samples)).as_bytes()
+
+
+def _lz4_open(level):
+    import lz4.frame
+    return partial(lz4.frame.open, compression_level=level)
+
+
+def _lz4_compress(level):
+    import lz4.frame
+    return partial(lz4.frame.compress, compression_level=level)
+
+
+def _stream_opener(compression, level):
+    if compression == 'gzip':
+        return partial(gzip.open, compresslevel=level)
+    elif compression == 'xz':
+        return partial(lzma.open, preset=level)
+    elif compression == 'bzip2':
+        return partial(bz2.open, compresslevel=level)
+    elif compression == 'lz4':
+        return _lz4_open(level)
+    else:
+        return open
+
+
+def _block_compressor(compression, level):
+    # each compressed block is a complete gzip member, xz stream, bzip2
+    # stream or lz4 frame, and a concatenation of these is a valid file of
+    # that type
+    if compression == 'gzip':
+        return partial(gzip.compress, compresslevel=level, mtime=0)
+    elif compression == 'xz':
+        return partial(lzma.compress, preset=level)
+    elif compression == 'bzip2':
+        return partial(bz2.compress, compresslevel=level)
+    elif compression == 'lz4':
+        return _lz4_compress(level)
+    else:
+        raise ValueError(f"Cannot block compress: {compression}")
+
+
+class BlockWriter(io.RawIOBase):
+    """Compress independent blocks concurrently, writing them in order.
+
+    Compression releases the GIL, so blocks handed to a thread pool are
+    compressed in parallel. Only a bounded number of blocks per file are
+    in flight at once. Without a pool, blocks are compressed as written.
+    """
+
+    def __init__(self, fp, compress, executor, blocksize, max_pending):
+        self._fp = fp
+        self._compress = compress
+        self._executor = executor
+        self._blocksize = blocksize
+        self._max_pending = max_pending
+        self._buf = bytearray()
+        self._pending = deque()
+        self._any_blocks = False
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._buf += b
+        while len(self._buf) >= self._blocksize:
+            self._submit(bytes(self._buf[:self._blocksize]))
+            del self._buf[:self._blocksize]
+        return len(b)
+
+    def _submit(self, block):
+        self._any_blocks = True
+        if self._executor is None:
+            self._write_block(self._compress(block), len(block))
+            return
+
+        self._pending.append((self._executor.submit(self._compress, block),
+                              len(block)))
+        while len(self._pending) > self._max_pending:
+            self._write_pending()
+
+    def _write_pending(self):
+        future, size = self._pending.popleft()
+        self._write_block(future.result(), size)
+
+    def _write_block(self, compressed, size):
+        self._fp.write(compressed)
+
+    def _finish(self):
+        pass
+
+    def close(self):
+        if not self.closed:
+            # an empty compressed file still needs a valid, empty, stream
+            if self._buf or not self._any_blocks:
+                self._submit(bytes(self._buf))
+                self._buf.clear()
+
+            while self._pending:
+                self._write_pending()
+            self._finish()
+            self._fp.close()
+        super().close()
+
+
+# the largest amount of data htslib places in a BGZF block
+BGZF_BLOCKSIZE = 0xff00
+
+# the empty block which terminates a BGZF file
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000'
+                         '000000000000')
+
+
+def _bgzf_block(data, level):
+    """Compress data as a single BGZF block."""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    deflated = compressor.compress(data) + compressor.flush()
+
+    # a gzip header with a BC extra field holding the block size, less one
+    header = struct.pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6,
+                         66, 67, 2, len(deflated) + 25)
+    trailer = struct.pack('<2I', zlib.crc32(data), len(data))
+    return header + deflated + trailer
+
+
+class BGZFWriter(BlockWriter):
+    """Write BGZF, along with its .gzi block index.
+
+    BGZF is gzip compatible, and as each block is independent, the blocks
+    can be compressed in parallel. The index follows the format of
+    `bgzip -i`: the number of entries, followed by the compressed and
+    uncompressed offset of every block other than the first, all as
+    little endian unsigned 64-bit integers.
+    """
+
+    def __init__(self, fp, index_path, level, executor, max_pending):
+        super().__init__(fp, partial(_bgzf_block, level=level), executor,
+                         BGZF_BLOCKSIZE, max_pending)
+        self._index_path = index_path
+        self._offsets = []
+        self._compressed_offset = 0
+        self._uncompressed_offset = 0
+
+    def _write_block(self, compressed, size):
+        self._offsets.append((self._compressed_offset,
+                              self._uncompressed_offset))
+        self._fp.write(compressed)
+        self._compressed_offset += len(compressed)
+        self._uncompressed_offset += size
+
+    def close(self):
+        # a BGZF file is never without a block, the EOF block is enough
+        self._any_blocks = True
+        super().close()
+
+    def _finish(self):
+        self._fp.write(BGZF_EOF)
+
+        offsets = self._offsets[1:]
+        with open(self._index_path, 'wb') as index:
+            index.write(struct.pack('<Q', len(offsets)))
+            for offset in offsets:
+                index.write(struct.pack('<2Q', *offset))
+
+
+class OutputCodec:
+    """Open output files compressed according to an extension.
+
+    With more than one thread, files are compressed as independent blocks
+    in a thread pool shared by every file opened through the codec. gzip
+    outputs can optionally be written as BGZF, with a .gzi index alongside.
+    zstd outputs are instead compressed on zstd's own worker threads, and
+    can use a dictionary shared by every file.
+    """
+
+    BLOCKSIZE = 1024 * 1024
+
+    def __init__(self, extension, threads=1, level=None, bgzf=False,
+                 zstd_dict=None):
+        if threads < 1:
+            raise ValueError("threads must be at least 1")
+
+        self._compression = compression_from_extension(extension)
+        module = COMPRESSION_MODULES.get(self._compression)
+        if module is not None and find_spec(module) is None:
+            raise ValueError(f"{self._compression} output requires the "
+                             f"'{module}' package")
+
+        if bgzf and self._compression != 'gzip':
+            raise ValueError("BGZF requires a gzip extension")
+
+        self._bgzf = bgzf
+        self._threads = threads
+        self._level = level
+        if level is None:
+            self._level = DEFAULT_LEVELS.get(self._compression)
+        self._executor = None
+
+        # only meaningful for zstd, and ignored otherwise
+        self._zstd_dict = zstd_dict
+        self._zstd_cdict = None
+
+    def __getstate__(self):
+        # a pool cannot cross a process boundary, so it is made on demand,
+        # as is the digested dictionary
+        state = self.__dict__.copy()
+        state['_executor'] = None
+        state['_zstd_cdict'] = None
+        return state
+
+    @property
+    def compression(self):
+        return self._compression
+
+    def open(self, path, mode='wb'):
+        """Open a path for writing in text ('wt') or binary ('wb') mode."""
+        if mode not in ('wb', 'wt'):
+            raise ValueError(f"Unsupported mode: {mode}")
+
+        if self._compression is None:
+            return open(path, mode)
+
+        if self._compression == 'zstd':
+            return self._open_zstd(path, mode)
+
+        if self._threads == 1 and not self._bgzf:
+            return _stream_opener(self._compression, self._level)(path, mode)
+
+        if self._executor is None and self._threads > 1:
+            self._executor = ThreadPoolExecutor(max_workers=self._threads)
+
+        if self._bgzf:
+            writer = BGZFWriter(open(path, 'wb'), f"{path}.gzi",
+                                self._level, self._executor,
+                                max_pending=2 * self._threads)
+        else:
+            writer = BlockWriter(open(path, 'wb'),
+                                 _block_compressor(self._compression,
+                                                   self._level),
+                                 self._executor, self.BLOCKSIZE,
+                                 max_pending=2 * self._threads)
+        binary = io.BufferedWriter(writer)
+
+        if mode == 'wt':
+            return io.TextIOWrapper(binary)
+        else:
+            return binary
+
+    def _open_zstd(self, path, mode):
+        import zstandard
+        if self._zstd_dict is not None and self._zstd_cdict is None:
+            # digest the dictionary once, rather than for every file
+            self._zstd_cdict = zstandard.ZstdCompressionDict(self._zstd_dict)
+            self._zstd_cdict.precompute_compress(level=self._level)
+
+        # zero threads compresses synchronously within the caller
+        threads = self._threads if self._threads > 1 else 0
+        cctx = zstandard.ZstdCompressor(level=self._level, threads=threads,
+                                        dict_data=self._zstd_cdict)
+        return zstandard.open(path, mode, cctx=cctx)
+
+    def close(self):
+        """Release the thread pool, if any."""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
@@ -12,3 +12,18 @@ DATA = 'data'
 PATH = 'path'
 ERROR = 'error'
 COMPLETE = 'complete'
+QUEUE = 'queue'
+SHM = 'shm'
+THREADS = 'threads'
+PROCESSES = 'processes'
+FORK = 'fork'
+FORKSERVER = 'forkserver'
+SPAWN = 'spawn'
+FILE_COMPLETE = 'file-complete'
+FILE_ORDER = 'file'
+ARRIVAL = 'arrival'
+MUX = 'mux'
+TOOL = 'tool'
+DEMUX = 'demux'
+ROUND_ROBIN = 'round-robin'
+LOAD = 'load'
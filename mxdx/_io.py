@@ -1,19 +1,36 @@
 import os
 import io
+import mmap
 import hashlib
 from collections import namedtuple
+from itertools import chain
 from dataclasses import dataclass
 import gzip
 import lzma
 import bz2
-import mimetypes
 from math import ceil
 
 import polars as pl
 
 from ._constants import R1, R2
-
-MuxFile = namedtuple("MuxFile", "file1 file2 start stop tag complete")
+from ._codec import open_gzip, open_lz4, open_zstd, ReadAhead
+
+MuxFile = namedtuple("MuxFile", ("file1 file2 start stop tag complete "
+                                 "format compression1 compression2"),
+                     defaults=(None, None, None))
+
+# magic bytes for the compression schemes we can read
+GZIP_MAGIC = b'\x1f\x8b'
+XZ_MAGIC = b'\xfd7zXZ\x00'
+BZIP2_MAGIC = b'BZh'
+LZ4_MAGIC = b'\x04"M\x18'
+ZSTD_MAGIC = b'(\xb5/\xfd'
+GZIP = 'gzip'
+XZ = 'xz'
+BZIP2 = 'bzip2'
+LZ4 = 'lz4'
+ZSTD = 'zstd'
+UNCOMPRESSED = 'none'
 
 
 @dataclass
@@ -97,6 +114,9 @@ class FileMap:
     _tmp = 'tmp'
     _hash_prefix = 'hash_prefix'
     _row_index = 'row_index'
+    _format = 'format'
+    _compression_1 = 'compression_1'
+    _compression_2 = 'compression_2'
     _hash_prefix_size = 3
 
     def __init__(self, df, batch_size):
@@ -131,6 +151,11 @@ class FileMap:
         if not self.is_paired:
             df = df.with_columns(pl.lit(None).alias(self._filename_2))
 
+        # sniffed details are optional, and when absent, are sniffed on read
+        for col in (self._format, self._compression_1, self._compression_2):
+            if col not in df.columns:
+                df = df.with_columns(pl.lit(None, dtype=pl.String).alias(col))
+
         self._df = df
 
     def batch(self, batch_number):
@@ -174,10 +199,12 @@ class FileMap:
             lag = 0
 
         col_order = [self._row_index, self._filename_1, self._filename_2,
-                     self._record_count, self._record_cumsum]
+                     self._record_count, self._record_cumsum, self._format,
+                     self._compression_1, self._compression_2]
 
         tups = []
-        for (ridx, f1, f2, cnt, cs) in rows.select(col_order).iter_rows():
+        for (ridx, f1, f2, cnt, cs, fmt, c1, c2) in \
+                rows.select(col_order).iter_rows():
             # adjust our start if needed
             file_start = lag
 
@@ -189,7 +216,8 @@ class FileMap:
             tag = f"{ridx}.{hp}.{batch_number}"
             tups.append(MuxFile(file1=f1, file2=f2, start=file_start,
                                 stop=file_stop, tag=tag,
-                                complete=is_complete))
+                                complete=is_complete, format=fmt,
+                                compression1=c1, compression2=c2))
 
             # adjust the amount remaining
             remaining -= (file_stop - file_start)
@@ -202,6 +230,15 @@ class FileMap:
 
         return tuple(tups)
 
+    def batches(self, batch_numbers):
+        """Get the MuxFiles of several batches, in the order given.
+
+        Each batch is split as it would be on its own, so a file spanning
+        batches is represented once per batch, under that batch's tag.
+        """
+        return tuple(mx for batch_number in batch_numbers
+                     for mx in self.batch(batch_number))
+
     @classmethod
     def from_tsv(cls, data, batch_size):
         df = pl.read_csv(data, separator='\t', infer_schema_length=0,
@@ -209,11 +246,53 @@ class FileMap:
         df = df.with_columns(pl.col(cls._record_count).cast(int))
         return cls(df, batch_size)
 
+    def to_tsv(self, path):
+        """Write the file map, including any sniffed details."""
+        cols = [self._filename_1]
+        if self.is_paired:
+            cols.append(self._filename_2)
+        cols += [self._record_count, self._format, self._compression_1]
+        if self.is_paired:
+            cols.append(self._compression_2)
+
+        self._df.select(cols).write_csv(path, separator='\t')
+
+    def annotate(self):
+        """Sniff the format and compression of files lacking these details.
+
+        Storing these details in the file map allows a batch to be set up
+        without opening its files, which is valuable on file systems where
+        an open is expensive.
+        """
+        cols = [self._filename_1, self._filename_2, self._format,
+                self._compression_1, self._compression_2]
+
+        formats = []
+        compression_1 = []
+        compression_2 = []
+        for f1, f2, fmt, c1, c2 in self._df.select(cols).iter_rows():
+            if fmt is None or c1 is None:
+                fmt, c1 = IO.sniff_file(f1)
+
+            if f2 is not None and c2 is None:
+                _, c2 = IO.sniff_file(f2)
+
+            formats.append(fmt)
+            compression_1.append(c1)
+            compression_2.append(c2)
+
+        self._df = self._df.with_columns(
+            pl.Series(self._format, formats, dtype=pl.String),
+            pl.Series(self._compression_1, compression_1, dtype=pl.String),
+            pl.Series(self._compression_2, compression_2, dtype=pl.String))
+        self._validate_annotations()
+
     def _validate(self):
         self._validate_header()
         self._validate_files()
         self._validate_counts()
         self._validate_batch_size()
+        self._validate_annotations()
 
     def _validate_batch_size(self):
         if self._batch_size <= 0:
@@ -233,17 +312,35 @@ class FileMap:
         if self._df[self._record_count].null_count() > 0:
             raise ValueError("Files with a null record count found")
 
+    def _validate_annotations(self):
+        columns = set(self._df.columns)
+
+        if self._format in columns:
+            observed = set(self._df[self._format].drop_nulls())
+            if not observed.issubset(IO.formats()):
+                raise ValueError(f"Unknown formats found: "
+                                 f"{observed - set(IO.formats())}")
+
+        for col in (self._compression_1, self._compression_2):
+            if col in columns:
+                observed = set(self._df[col].drop_nulls())
+                if not observed.issubset(IO.compressions()):
+                    raise ValueError(f"Unknown compression found: "
+                                     f"{observed - set(IO.compressions())}")
+
     def _validate_header(self):
         columns = set(self._df.columns)
+        required = {self._filename_1, self._record_count}
+        optional = {self._filename_2, self._format, self._compression_1,
+                    self._compression_2}
 
-        if len(columns) == 2:
-            if columns != {self._filename_1, self._record_count}:
-                raise ValueError("Header structure is unexpected")
-        elif len(columns) == 3:
-            if columns != {self._filename_1, self._filename_2,
-                           self._record_count}:
-                raise ValueError("Header structure is unexpected")
-        else:
+        if not required.issubset(columns):
+            raise ValueError("Header structure is unexpected")
+
+        if not columns.issubset(required | optional):
+            raise ValueError("Header structure is unexpected")
+
+        if self._compression_2 in columns and self._filename_2 not in columns:
             raise ValueError("Header structure is unexpected")
 
     @property
@@ -267,6 +364,18 @@ class FileMap:
             return tuple(missing)
 
 
+class _OwningTextIOWrapper(io.TextIOWrapper):
+    """Text over a decompressor which also closes the underlying file."""
+
+    def __init__(self, buffer, raw):
+        super().__init__(buffer)
+        self._raw = raw
+
+    def close(self):
+        super().close()
+        self._raw.close()
+
+
 class SniffError(Exception):
     pass
 
@@ -279,7 +388,8 @@ class ParseError(Exception):
 class IO:
     @classmethod
     def valid_interleave(cls):
-        return {cls.read_fasta, cls.read_fastq}
+        return {cls.read_fasta, cls.read_fastq,
+                cls.read_fasta_strict, cls.read_fastq_strict}
 
     @staticmethod
     def io_from_stream(stream, n_lines=4):
@@ -301,27 +411,113 @@ class IO:
         return stream, read_f, write_f
 
     @staticmethod
-    def io_from_mx(mxfile):
-        open_f = IO.opener(mxfile.file1)
-        with open_f(mxfile.file1, 'rt') as fp:
-            read_f, write_f = IO.sniff(IO.read_n(fp))
+    def io_from_mx(mxfile, gzip_backend=None):
+        open_f = IO.open_input
+        if mxfile.format is not None:
+            # the file map already tells us, so avoid opening the file
+            read_f, write_f = IO.formats()[mxfile.format]
+        else:
+            with open_f(mxfile.file1, mxfile.compression1,
+                        gzip_backend) as fp:
+                read_f, write_f = IO.sniff(IO.read_n(fp))
         return (open_f, read_f, write_f)
 
+    @classmethod
+    def formats(cls):
+        return {'fasta': (cls.read_fasta, cls.write_fasta),
+                'fasta-strict': (cls.read_fasta_strict, cls.write_fasta),
+                'fastq': (cls.read_fastq, cls.write_fastq),
+                'fastq-strict': (cls.read_fastq_strict, cls.write_fastq),
+                'sam': (cls.read_sam, cls.write_sam)}
+
+    @classmethod
+    def format_name(cls, read_f):
+        for name, (fn_read, _) in cls.formats().items():
+            if fn_read == read_f:
+                return name
+        raise ValueError(f"Unknown reader: {read_f}")
+
+    @staticmethod
+    def compressions():
+        return {GZIP: GZIP_MAGIC, XZ: XZ_MAGIC, BZIP2: BZIP2_MAGIC,
+                LZ4: LZ4_MAGIC, ZSTD: ZSTD_MAGIC, UNCOMPRESSED: None}
+
+    @staticmethod
+    def compression_from_magic(magic):
+        for name, expected in IO.compressions().items():
+            if expected is not None and magic.startswith(expected):
+                return name
+        return UNCOMPRESSED
 
     @staticmethod
-    def opener(path):
-        _, encoding = mimetypes.guess_type(path)
-        if encoding is None:
-            # maybe its just flat text...
-            return open
-        elif encoding == 'gzip':
-            return gzip.open
-        elif encoding == 'xz':
-            return lzma.open
-        elif ext == 'bzip2':
-            return bz2.open
+    def open_input(path, compression=None, gzip_backend=None):
+        """Open a file for reading text.
+
+        Compression is determined from the magic bytes of the opened file
+        unless it is provided, so the file is only opened once regardless
+        of its extension.
+        """
+        raw = open(path, 'rb')
+        if compression is None:
+            compression = IO.compression_from_magic(raw.peek(8))
+
+        return IO._decompressed_text(raw, compression, gzip_backend)
+
+    @staticmethod
+    def decompressed(raw, compression=None, gzip_backend=None,
+                     zstd_dict=None, gzip_threads=None):
+        """Decompress a binary file handle.
+
+        The caller remains responsible for closing the handle.
+        """
+        if compression is None:
+            compression = IO.compression_from_magic(raw.peek(8))
+
+        if compression == UNCOMPRESSED:
+            return raw
+        elif compression == GZIP:
+            return open_gzip(raw, gzip_backend, gzip_threads)
+        elif compression == XZ:
+            return lzma.LZMAFile(raw)
+        elif compression == BZIP2:
+            return bz2.BZ2File(raw)
+        elif compression == LZ4:
+            return open_lz4(raw)
+        elif compression == ZSTD:
+            return open_zstd(raw, zstd_dict)
         else:
-            return open
+            raise ValueError(f"Unknown compression: {compression}")
+
+    @staticmethod
+    def _decompressed_text(raw, compression, gzip_backend=None,
+                           read_ahead=False, gzip_threads=None):
+        try:
+            decompressed = IO.decompressed(raw, compression, gzip_backend,
+                                           gzip_threads=gzip_threads)
+        except ValueError:
+            raw.close()
+            raise
+
+        if decompressed is raw:
+            return io.TextIOWrapper(raw)
+
+        if read_ahead:
+            decompressed = io.BufferedReader(ReadAhead(decompressed))
+
+        return _OwningTextIOWrapper(decompressed, raw)
+
+    @staticmethod
+    def sniff_file(path):
+        """Determine the format and compression of a file in one open."""
+        raw = open(path, 'rb')
+        compression = IO.compression_from_magic(raw.peek(8))
+        with IO._decompressed_text(raw, compression) as fp:
+            read_f, _ = IO.sniff(IO.read_n(fp))
+
+        if read_f is None:
+            raise SniffError(f"Unable to determine the format of {path}")
+
+        return IO.format_name(read_f), compression
 
     @staticmethod
     def read_n(fp, n=40):
@@ -341,10 +537,47 @@ class IO:
         for fn_read, fn_write in io_pairs:
             buf.seek(0)
             if next(fn_read(buf)) is not None:
-                return (fn_read, fn_write)
+                buf.seek(0)
+                return (cls._strict_variant(fn_read, buf), fn_write)
 
         return None, None
 
+    @classmethod
+    def _strict_variant(cls, fn_read, buf):
+        """Use a strict reader if the sample has a strict layout.
+
+        Strict FASTQ is four lines per record, and strict FASTA is two lines
+        per record. Only complete records in the sample are examined, as a
+        sample taken from a stream may be truncated.
+        """
+        if fn_read == cls.read_fastq:
+            n, fn_strict = 4, cls.read_fastq_strict
+        elif fn_read == cls.read_fasta:
+            n, fn_strict = 2, cls.read_fasta_strict
+        else:
+            return fn_read
+
+        lines = buf.read().splitlines(keepends=True)
+        if lines and not lines[-1].endswith('\n'):
+            lines = lines[:-1]
+
+        records = [lines[i:i + n] for i in range(0, len(lines) - n + 1, n)]
+        if len(records) == 0:
+            return fn_read
+
+        for record in records:
+            if n == 4:
+                header, seq, plus, qual = record
+                if (header[0] != '@' or plus[0] != '+'
+                        or len(seq) != len(qual)):
+                    return fn_read
+            else:
+                header, seq = record
+                if header[0] != '>' or seq[0] in '>@+':
+                    return fn_read
+
+        return fn_strict
+
     @staticmethod
     def read(fn, data, start, stop, orient):
         if start < 0:
@@ -357,6 +590,8 @@ class IO:
             count += 1
 
         for rec in record_gen:
+            if rec is None:
+                raise ParseError("Unable to parse records")
             rec.set_orientation(orient)
             yield rec
             count += 1
@@ -366,6 +601,99 @@ class IO:
         if count < stop:
             raise ParseError("Reader exhausted but expected more records")
 
+    @classmethod
+    def _mappable(cls):
+        # strict readers, and their general counterparts, where a record is
+        # a fixed number of lines and can be found by scanning for newlines
+        return {cls.read_fasta_strict: (cls.read_fasta, 2),
+                cls.read_fastq_strict: (cls.read_fastq, 4),
+                cls.read_sam: (cls.read_sam, 1)}
+
+    @staticmethod
+    def read_file(fn, path, compression, start, stop, orient,
+                  gzip_backend=None, read_ahead=False, gzip_threads=None):
+        """Read records from a path, memory mapping it where possible.
+
+        Uncompressed data in a fixed line layout are memory mapped, which
+        lets us skip to the start of our records by scanning for newlines
+        rather than parsing every record before them. Compressed data can be
+        decompressed ahead of parsing in a background thread.
+        """
+        raw = open(path, 'rb')
+        if compression is None:
+            compression = IO.compression_from_magic(raw.peek(8))
+
+        if (compression == UNCOMPRESSED and fn in IO._mappable()
+                and os.fstat(raw.fileno()).st_size > 0):
+            return IO._read_mapped(fn, raw, start, stop, orient)
+        else:
+            data = IO._decompressed_text(raw, compression, gzip_backend,
+                                         read_ahead, gzip_threads)
+            return IO._read_closing(fn, data, start, stop, orient)
+
+    @staticmethod
+    def _read_closing(fn, data, start, stop, orient):
+        # we may stop before the end of the data, so make sure the handle,
+        # and anything reading ahead on it, is closed when we are done
+        with data:
+            yield from IO.read(fn, data, start, stop, orient)
+
+    @staticmethod
+    def _read_mapped(fn, raw, start, stop, orient):
+        if start < 0:
+            raise ValueError("start must be positive")
+
+        general_fn, n_lines = IO._mappable()[fn]
+
+        with raw, mmap.mmap(raw.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            count = 0
+            lines = []
+            for block, pos in _mapped_lines(mm):
+                lines += block
+                n_complete = len(lines) - (len(lines) % n_lines)
+
+                # a wrapped fasta record is only apparent from the line
+                # following it, so hold the last record back if we can
+                if n_lines == 2 and pos < len(mm) and n_complete == len(lines):
+                    n_complete -= n_lines
+                for i in range(0, n_complete, n_lines):
+                    record = lines[i:i + n_lines]
+                    following = lines[i + 2] if i + 2 < len(lines) else None
+
+                    if not _mapped_valid(record, following):
+                        # our layout assumption does not hold from here on,
+                        # so let the general parser pick up where we left off
+                        raw.seek(pos)
+                        remaining = chain((line.decode('utf-8') + '\n'
+                                           for line in lines[i:]),
+                                          io.TextIOWrapper(raw))
+                        yield from IO.read(general_fn, remaining,
+                                           max(start - count, 0),
+                                           stop - count, orient)
+                        return
+
+                    if count >= start:
+                        rec = _mapped_record(record)
+                        rec.set_orientation(orient)
+                        yield rec
+
+                    count += 1
+                    if count == stop:
+                        return
+
+                lines = lines[n_complete:]
+
+            if lines and count < stop:
+                # an incomplete trailing record
+                remaining = (line.decode('utf-8') + '\n' for line in lines)
+                yield from IO.read(general_fn, remaining,
+                                   max(start - count, 0), stop - count,
+                                   orient)
+                return
+
+        if count < stop:
+            raise ParseError("Reader exhausted but expected more records")
+
     @staticmethod
     def read_fasta(data):
         try:
@@ -377,6 +705,17 @@ class IO:
         except (SniffError, ParseError):
             yield None
 
+    @staticmethod
+    def read_fasta_strict(data):
+        try:
+            for id_, seq, qual in _readfa_strict(data):
+                if qual is not None:
+                    raise SniffError("Data are fastq")
+                data = seq + '\n'
+                yield FastaRecord(id=id_, data=data)
+        except (SniffError, ParseError):
+            yield None
+
     @staticmethod
     def write_fasta(record):
         return f">{record.id}\n{record.data}"
@@ -392,6 +731,17 @@ class IO:
         except (SniffError, ParseError):
             yield None
 
+    @staticmethod
+    def read_fastq_strict(data):
+        try:
+            for id_, seq, qual in _readfq_strict(data):
+                if qual is None:
+                    raise SniffError("Data are not fastq")
+                data = f"{seq}\n+\n{qual}\n"
+                yield FastqRecord(id=id_, data=data)
+        except (SniffError, ParseError):
+            yield None
+
     @staticmethod
     def write_fastq(record):
         return f"@{record.id}\n{record.data}"
@@ -454,6 +804,117 @@ def _readfq(fp): # this is a generator function
         raise ParseError("Data do not appear to be fasta or fastq")
 
 
+def _readfq_general(lines, fp, count):
+    """Continue parsing with the general parser after a strict violation."""
+    try:
+        yield from _readfq(chain(lines, fp))
+    except ParseError:
+        # the general parser complains if it did not observe any records,
+        # which is only a problem if we have not observed any either
+        if count == 0:
+            raise
+
+
+def _readfq_strict(fp):
+    """Parse four line FASTQ, deferring to _readfq if the layout differs."""
+    count = 0
+    fp = iter(fp)
+    for header in fp:
+        seq = next(fp, None)
+        plus = next(fp, None)
+        qual = next(fp, None)
+
+        if (qual is None or header[0] != '@' or plus[0] != '+'
+                or len(seq) != len(qual)):
+            lines = [line for line in (header, seq, plus, qual)
+                     if line is not None]
+            yield from _readfq_general(lines, fp, count)
+            return
+
+        yield header[1:-1].partition(" ")[0], seq[:-1], qual[:-1]
+        count += 1
+
+    if count == 0:
+        raise ParseError("Data do not appear to be fasta or fastq")
+
+
+def _readfa_strict(fp):
+    """Parse two line FASTA, deferring to _readfq if the layout differs."""
+    count = 0
+    fp = iter(fp)
+    header = next(fp, None)
+    while header is not None:
+        seq = next(fp, None)
+
+        # we need to see the next header to know the sequence is not wrapped
+        following = next(fp, None)
+
+        if (seq is None or header[0] != '>' or seq[0] in '>@+'
+                or (following is not None and following[0] != '>')):
+            lines = [line for line in (header, seq, following)
+                     if line is not None]
+            yield from _readfq_general(lines, fp, count)
+            return
+
+        yield header[1:-1].partition(" ")[0], seq[:-1], None
+        count += 1
+        header = following
+
+    if count == 0:
+        raise ParseError("Data do not appear to be fasta or fastq")
+
+
+def _mapped_lines(mm, blocksize=1024 * 1024):
+    """Yield lines of a mapped file, in blocks, with where the next begins.
+
+    Splitting a block at once is substantially faster than searching for
+    each newline individually.
+    """
+    size = len(mm)
+    pos = 0
+    while pos < size:
+        end = mm.rfind(b'\n', pos, min(pos + blocksize, size))
+        if end == -1 or pos + blocksize >= size:
+            end = size
+            if mm[size - 1:size] == b'\n':
+                end -= 1
+
+        block = mm[pos:end].split(b'\n')
+        pos = end + 1
+        yield block, pos
+
+
+def _mapped_valid(record, following):
+    """Check whether lines of a mapped file are a strict record."""
+    if len(record) == 4:
+        header, seq, plus, qual = record
+        return (header[:1] == b'@' and plus[:1] == b'+'
+                and len(seq) == len(qual))
+    elif len(record) == 2:
+        header, seq = record
+        return (header[:1] == b'>'
+                and seq[:1] not in (b'>', b'@', b'+', b'')
+                and (following is None or following[:1] == b'>'))
+    else:
+        return b'\t' in record[0]
+
+
+def _mapped_record(record):
+    """Construct a record from lines of a mapped file."""
+    if len(record) == 4:
+        header, seq, _, qual = record
+        id_ = header[1:].decode('utf-8').partition(" ")[0]
+        data = b"%s\n+\n%s\n" % (seq, qual)
+        return FastqRecord(id=id_, data=data.decode('utf-8'))
+    elif len(record) == 2:
+        header, seq = record
+        id_ = header[1:].decode('utf-8').partition(" ")[0]
+        return FastaRecord(id=id_, data=seq.decode('utf-8') + '\n')
+    else:
+        id_, remainder = record[0].decode('utf-8').split('\t', 1)
+        return SamRecord(id=id_, data=remainder + '\n')
+
+
 def _readsam(data):
     first = True
     for line in data:
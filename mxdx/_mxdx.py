@@ -1,32 +1,99 @@
 import sys
 import os
 import multiprocessing as mp
-from itertools import chain
-from functools import lru_cache
+from multiprocessing import shared_memory
+from multiprocessing.connection import wait
+from itertools import chain, cycle
+from functools import lru_cache, partial
 from collections import deque, defaultdict
 import io
 import glob
 import re
 import time
-from multiprocessing.synchronize import SEM_VALUE_MAX
+import queue
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 from ._io import IO, MuxFile
+from ._codec import resolve_gzip_backend, available_cores, OutputCodec
+from ._pipe import (grow_pipe, write_all, pipe_queued, IOV_MAX, PipeEnd,
+                    IdleReader)
 from ._constants import (INTERLEAVE, R1ONLY, R2ONLY, SEQUENTIAL,
                          READ_COMPLETE, R1, R2, MERGE, SEQUENTIAL,
-                         SEPARATE, PARTIAL, PATH, DATA, ERROR, COMPLETE)
+                         SEPARATE, PARTIAL, PATH, DATA, ERROR, COMPLETE,
+                         QUEUE, SHM, THREADS, PROCESSES, SPAWN, FORKSERVER,
+                         FILE_COMPLETE, FILE_ORDER, ARRIVAL, ROUND_ROBIN,
+                         LOAD)
 
+# the most data allowed in flight between a reader and a writer
+MAX_BUFFER_MB = 64
 
-class Multiplex:
+# the capacity we ask of a pipe on standard input or output
+PIPE_SIZE_MB = 1
+
+# what a forkserver imports before forking children
+FORKSERVER_PRELOAD = ['mxdx._mxdx']
+
+# messages in a transport which are not chunks
+MARKERS = (READ_COMPLETE, FILE_COMPLETE)
+
+
+class _PickledWithoutFileMap:
+    """Leave the file map behind when pickled for a child process."""
+
+    def __getstate__(self):
+        # our children only need the batch, not the whole file map, which
+        # can be large to pickle and to rebuild
+        state = self.__dict__.copy()
+        state['_file_map'] = None
+        return state
+
+
+class Multiplex(_PickledWithoutFileMap):
     """Multiplex records from a file batch."""
 
-    def __init__(self, file_map, batch, paired_handling, output):
+    def __init__(self, file_map, batch, paired_handling, output,
+                 gzip_backend=None, prefetch=2, compression_threads=1,
+                 compression_level=None, transport=QUEUE,
+                 max_buffer_mb=MAX_BUFFER_MB, engine=PROCESSES,
+                 start_method=SPAWN, pipe_size_mb=PIPE_SIZE_MB,
+                 direct_write=True, readers=1, reader_order=FILE_ORDER,
+                 distribution=ROUND_ROBIN):
         self._file_map = file_map
         self._batch = batch
-        self._mxfiles = file_map.batch(batch)
+        self._mxfiles = _batch_mxfiles(file_map, batch)
         self._paired_handling = paired_handling
         self._output = output
-
-        open_f, read_f, write_f = IO.io_from_mx(self._mxfiles[0])
+        self._prefetch = prefetch
+        self._readers, self._ordered = _validate_readers(
+            readers, reader_order, len(self._mxfiles))
+        self._pipe_size = _validate_pipe_size(pipe_size_mb)
+        self._direct_write = direct_write
+        self._transport, self._max_buffer = _validate_transport(
+            transport, max_buffer_mb)
+        self._engine, self._start_method = _validate_engine(engine,
+                                                            start_method)
+
+        # chunks are dealt across several pipes, e.g. to shards of a tool
+        if distribution not in (ROUND_ROBIN, LOAD):
+            raise ValueError(f"Unknown distribution: {distribution}")
+        self._distribution = distribution
+
+        # a file output is compressed according to its extension
+        self._codec = None
+        if output != '-' and not isinstance(output, (PipeEnd, list)):
+            self._codec = OutputCodec(os.path.basename(output),
+                                      compression_threads, compression_level)
+
+        if prefetch < 0:
+            raise ValueError("prefetch cannot be negative")
+
+        # resolve here so our children agree on the backend
+        self._gzip_backend = resolve_gzip_backend(gzip_backend)
+
+        open_f, read_f, write_f = IO.io_from_mx(self._mxfiles[0],
+                                                self._gzip_backend)
         self._open_f = open_f
         self._read_f = read_f
         self._write_f = write_f
@@ -36,42 +103,113 @@ class Multiplex:
                 raise ValueError("Data are not paired")
 
         if self._paired_handling == INTERLEAVE:
-            if self._read_f not in IO.valid_interleave():
+            formats = IO.formats()
+            read_fs = {formats[mx.format][0] for mx in self._mxfiles
+                       if mx.format is not None}
+            read_fs.add(self._read_f)
+            if not read_fs.issubset(IO.valid_interleave()):
                 raise ValueError("Unable to interleave format")
 
-        self.queue = None
+        # a parallel gzip backend would decompress each file we hold open on
+        # every core, so share the cores over our readers, their prefetched
+        # files, and the mates of each
+        if file_map.is_paired and self._paired_handling not in (R1ONLY,
+                                                                R2ONLY):
+            per_mxfile = 2
+        else:
+            per_mxfile = 1
+        concurrent = self._readers * (self._prefetch + 1) * per_mxfile
+        self._gzip_threads = max(1, available_cores() // concurrent)
 
-    def _read_interleaved(self, r1_reader, r2_reader):
-        for rec1, rec2 in zip(r1_reader, r2_reader):
-            yield rec1
-            yield rec2
+        self._chunked_queues = None
+        self._nbytes = None
+
+    @property
+    def nbytes(self):
+        """The bytes written by the last start."""
+        return 0 if self._nbytes is None else self._nbytes.value
 
     def _read_sequential(self, r1_reader, r2_reader):
         for rec in chain(r1_reader, r2_reader):
             yield rec
 
-    def read(self):
-        """Read requested records, tag them, and emplace in a queue."""
-        mode = 'rt'
+    def _open_readers(self, mxfile):
+        """Open the record readers needed for a MuxFile."""
+        file1, file2, start, stop = mxfile[:4]
 
-        read_f = self._read_f
-        open_f = self._open_f
+        # use what the file map knows about this file if we can
+        if mxfile.format is None:
+            read_f = self._read_f
+        else:
+            read_f, _ = IO.formats()[mxfile.format]
+
+        # decompress in background threads, leaving parsing to the reader.
+        # this lets R1 and R2 decompress concurrently, and lets prefetched
+        # files start decompressing before we get to them
+        read_ahead = self._prefetch > 0 or (
+            file2 is not None and
+            self._paired_handling in (INTERLEAVE, SEQUENTIAL))
+
+        rec1_reader = None
+        rec2_reader = None
+        if self._paired_handling != R2ONLY:
+            rec1_reader = IO.read_file(read_f, file1, mxfile.compression1,
+                                       start, stop, R1, self._gzip_backend,
+                                       read_ahead, self._gzip_threads)
+        if file2 is not None and self._paired_handling != R1ONLY:
+            rec2_reader = IO.read_file(read_f, file2, mxfile.compression2,
+                                       start, stop, R2, self._gzip_backend,
+                                       read_ahead, self._gzip_threads)
+        return rec1_reader, rec2_reader
+
+    def _prefetched_readers(self, mxfiles):
+        """Yield MuxFiles with their readers, opening upcoming files early.
+
+        On a network file system an open, and fetching the first block,
+        can stall. Opening the next few MuxFiles in the background while
+        the current one streams hides that latency.
+        """
+        if self._prefetch == 0:
+            for mxfile in mxfiles:
+                yield mxfile, self._open_readers(mxfile)
+            return
+
+        with ThreadPoolExecutor(max_workers=self._prefetch) as executor:
+            pending = deque()
+            mxfiles = iter(mxfiles)
+            while True:
+                # keep the current file, and our prefetch depth, in flight
+                while len(pending) <= self._prefetch:
+                    upcoming = next(mxfiles, None)
+                    if upcoming is None:
+                        break
+                    future = executor.submit(self._open_readers, upcoming)
+                    pending.append((upcoming, future))
+
+                if not pending:
+                    break
 
-        for mxfile in self._mxfiles:
-            file1, file2, start, stop, tag, _ = mxfile
+                mxfile, future = pending.popleft()
+                yield mxfile, future.result()
 
-            # setup our record readers
-            f1_opened = open_f(file1, mode)
-            rec1_reader = IO.read(read_f, f1_opened, start, stop, R1)
-            if file2 is None:
-                rec2_reader = None
-            else:
-                f2_opened = open_f(file2, mode)
-                rec2_reader = IO.read(read_f, f2_opened, start, stop, R2)
+    def read(self, worker=0):
+        """Read requested records, tag them, and emplace in a queue.
+
+        With several readers, MuxFiles are dealt to them in turn, so this
+        reader takes every Nth MuxFile starting from its own index.
+        """
+        chunked_queue = self._chunked_queues[worker]
+        mxfiles = self._mxfiles[worker::self._readers]
+        for mxfile, (rec1_reader, rec2_reader) in \
+                self._prefetched_readers(mxfiles):
+            tag = mxfile.tag
 
             # setup the reading mode relative to paired handling
             if self._paired_handling == INTERLEAVE:
-                reader = self._read_interleaved(rec1_reader, rec2_reader)
+                # a pair is placed at once, so a chunk never splits a pair
+                # and each pair reaches the same shard of a tool
+                reader = (rec1.tag(tag).write() + rec2.tag(tag).write()
+                          for rec1, rec2 in zip(rec1_reader, rec2_reader))
             elif self._paired_handling == SEQUENTIAL:
                 if rec2_reader is None:
                     reader = rec1_reader
@@ -84,152 +222,760 @@ class Multiplex:
             else:
                 raise ValueError("Unknown paired handling mode.")
 
-            # place our records into the queue
-            for rec in reader:
-                self.buffered_queue.put(rec.tag(tag))
+            # serialize our records into the queue
+            if self._paired_handling == INTERLEAVE:
+                for pair in reader:
+                    chunked_queue.put(pair)
+            else:
+                for rec in reader:
+                    chunked_queue.put(rec.tag(tag).write())
+
+            # let the writer know to move on to the next reader
+            if self._ordered:
+                chunked_queue.file_complete()
 
         # signal that we are done reading
-        self._read_complete()
+        chunked_queue.complete()
 
     def write(self):
         """Write records from a queue to an output."""
-        if self._output == '-':
-            output = sys.stdout
+        if isinstance(self._output, list):
+            fds = [output.fd for output in self._output]
+            for fd in fds:
+                grow_pipe(fd, self._pipe_size)
+            self._write_chunks(self._dealer(fds), batched=True)
+        elif self._codec is None:
+            # stdout, or a pipe we were handed
+            if self._output == '-':
+                fd = sys.stdout.fileno()
+                sys.stdout.flush()
+            else:
+                fd = self._output.fd
+
+            # a larger pipe lets us run further ahead of a bursty consumer
+            grow_pipe(fd, self._pipe_size)
+
+            if self._direct_write:
+                # skip the buffered writer, which would copy each chunk,
+                # and hand whatever chunks are waiting to a single writev
+                self._write_chunks(lambda chunks: write_all(fd, chunks),
+                                   batched=True)
+            else:
+                if self._output == '-':
+                    output = sys.stdout.buffer
+                else:
+                    output = open(fd, 'wb', closefd=False)
+                if self._write_chunks(output.write):
+                    output.flush()
         else:
             # the expected usecase is to output over standard output. however,
-            # it is easy to support basic file handling which may be useful
-            # for debugging. given the expected usecase is stdout, and the user
-            # is free to compress or transform that stream however they want,
-            # we are not investing additional development to support other
-            # output formats
-            output = open(self._output, 'w')
+            # a stream staged to disk, e.g. for tools which cannot read stdin
+            # or to rerun against several databases, is compressed here so
+            # that staging is not limited by a separate single threaded step
+            output = self._codec.open(self._output, 'wb')
+            self._write_chunks(output.write)
+            output.close()
+            self._codec.close()
 
-        while True:
-            # get a block of records
-            recs = self.buffered_queue.get()
+        self._write_complete()
 
-            # if we are complete then terminate gracefully
-            if recs == READ_COMPLETE:
-                break
+    def _dealer(self, fds):
+        """Make a function which deals each of a list of chunks to a pipe.
 
-            # otherwise, write each record
-            for rec in recs:
-                try:
-                    output.write(rec.write())
-                except BrokenPipeError:
-                    # something bad happened downstream
-                    self._terminate()
-                    break
+        Chunks hold whole records, or whole pairs when interleaved, so any
+        chunk can go to any pipe. Chunks are dealt in turn, or, by load, to
+        the pipe with the least waiting to be read, falling back to turns
+        where that is unknown.
+        """
+        turns = cycle(range(len(fds)))
 
-        if self._output != '-':
-            output.close()
+        def by_turn():
+            return fds[next(turns)]
 
-        self._write_complete()
+        def by_load():
+            # rotate who wins a tie, so idle pipes are all used
+            start = next(turns)
+            order = fds[start:] + fds[:start]
+            queued = [pipe_queued(fd) for fd in order]
+            if None in queued:
+                return order[0]
+            return order[queued.index(min(queued))]
+
+        choose = by_load if self._distribution == LOAD else by_turn
+
+        def deal(chunks):
+            for chunk in chunks:
+                write_all(choose(), [chunk])
+
+        return deal
+
+    def _write_chunks(self, write_f, batched=False):
+        """Write chunks until the readers complete, or downstream fails.
+
+        If batched, write_f is given a list of the chunks waiting, and
+        otherwise a single chunk. Returns whether the readers completed.
+        """
+        nbytes = 0
+        try:
+            for chunks in self._merged(IOV_MAX if batched else 1):
+                if batched:
+                    write_f(chunks)
+                else:
+                    for chunk in chunks:
+                        write_f(chunk)
+                nbytes += sum(len(chunk) for chunk in chunks)
+        except BrokenPipeError:
+            # something bad happened downstream
+            self._terminate()
+            return False
+        finally:
+            self._nbytes.value = nbytes
+
+            # what we got last is still held, and would otherwise keep the
+            # shared memory from closing as we exit
+            for chunked_queue in self._chunked_queues:
+                chunked_queue.release()
+
+        return True
+
+    def _merged(self, limit):
+        """Yield lists of chunks from the readers in the order to write."""
+        queues = self._chunked_queues
+        if self._ordered:
+            # MuxFiles were dealt to the readers in turn, so we take a file
+            # from each reader in turn. the others continue reading ahead
+            # until their own buffer is full
+            for chunked_queue in cycle(queues):
+                while True:
+                    msgs = chunked_queue.get_many(limit)
+                    marker = msgs.pop() if msgs[-1] in MARKERS else None
+                    yield [chunk for chunk, _ in msgs]
+
+                    # the reader due the next file has no files left
+                    if marker == READ_COMPLETE:
+                        return
+                    elif marker == FILE_COMPLETE:
+                        break
+        else:
+            for msgs in _shared_messages(queues[0], self._readers, limit):
+                yield [chunk for chunk, _ in msgs]
 
     def _terminate(self):
-        self.msg_queue.put(ERROR)
+        self.msg_pipe.send(ERROR)
 
     def _write_complete(self):
-        self.msg_queue.put(COMPLETE)
+        self.msg_pipe.send(COMPLETE)
+
+    def _make_queues(self, ctx):
+        # in file order, each reader has its own transport so the writer can
+        # take from one while the others wait, and otherwise they share one
+        if self._ordered:
+            max_bytes = self._max_buffer // self._readers
+            transports = [_make_transport(ctx, self._transport, max_bytes)
+                          for _ in range(self._readers)]
+        else:
+            transports = [_make_transport(ctx, self._transport,
+                                          self._max_buffer)]
 
-    def _read_complete(self):
-        self.buffered_queue.put(READ_COMPLETE)
+        return transports, _reader_queues(transports, self._readers)
 
     def start(self):
-        """Start the Multiplexing."""
-        ctx = mp.get_context('spawn')
-        self.buffered_queue = BufferedQueue(ctx)
-        self.msg_queue = ctx.Queue(maxsize=16)
-
-        reader = ctx.Process(target=self.read)
+        """Start the Multiplexing, returning whether it completed."""
+        ctx = _get_context(self._engine, self._start_method)
+        transports, self._chunked_queues = self._make_queues(ctx)
+        self._nbytes = ctx.Value('q', 0, lock=False)
+        messages, self.msg_pipe = ctx.Pipe(duplex=False)
+
+        readers = [ctx.Process(target=partial(self.read, reader))
+                   for reader in range(self._readers)]
         writer = ctx.Process(target=self.write)
 
-        reader.start()
+        for reader in readers:
+            reader.start()
         writer.start()
 
-        # monitor reader and writer externally and kill if requested
-        while True:
-            time.sleep(0.1)
-            if self.msg_queue.empty():
-                continue
+        try:
+            return _supervise(self.__class__, readers + [writer], messages)
+        finally:
+            messages.close()
+            self.msg_pipe.close()
+            for transport in transports:
+                transport.close()
+
+
+class QueueTransport:
+    """Move chunks between stages through a queue.
+
+    The queue is bounded by the bytes in flight rather than by a number of
+    items, as multiprocessing.Queue has an OS dependent max size, which can
+    be unexpectedly small, see
+    https://github.com/python/cpython/issues/119534. The producer blocks
+    while the bound would be exceeded, so a stalled consumer cannot grow
+    the buffer. A single chunk larger than the bound is let through once
+    nothing else is in flight.
+    """
 
-            msg = self.msg_queue.get()
+    def __init__(self, ctx, max_bytes):
+        self._queue = ctx.Queue()
+        self._max_bytes = max_bytes
+        self._in_flight = ctx.Value('q', 0, lock=False)
+        self._cond = ctx.Condition()
+
+    def _has_room(self, nbytes):
+        in_flight = self._in_flight.value
+        return in_flight == 0 or in_flight + nbytes <= self._max_bytes
+
+    def put(self, parts, meta):
+        """Send the concatenation of bytes parts with its metadata."""
+        data = b''.join(parts)
+        with self._cond:
+            self._cond.wait_for(lambda: self._has_room(len(data)))
+            self._in_flight.value += len(data)
+        self._queue.put((data, meta))
+
+    def mark(self, marker):
+        """Send a marker, such as READ_COMPLETE, in place of a chunk."""
+        self._queue.put(marker)
+
+    def complete(self):
+        self.mark(READ_COMPLETE)
+
+    def _received(self, msg):
+        if msg not in MARKERS:
+            with self._cond:
+                self._in_flight.value -= len(msg[0])
+                self._cond.notify_all()
+        return msg
 
-            if msg == ERROR:
-                print(f"Error received in {self.__class__}; terminating",
-                      file=sys.stderr, flush=True)
-                reader.terminate()
-                writer.terminate()
-                break
-            elif msg == COMPLETE:
+    def get(self):
+        return self._received(self._queue.get())
+
+    def get_many(self, limit):
+        """Get a message, and whichever follow it without waiting.
+
+        At most limit messages are returned, and none after a marker.
+        """
+        msgs = [self.get()]
+        while len(msgs) < limit and msgs[-1] not in MARKERS:
+            try:
+                msg = self._queue.get_nowait()
+            except queue.Empty:
                 break
-            time.sleep(0.1)
+            msgs.append(self._received(msg))
+        return msgs
+
+    def release(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class SharedMemoryTransport:
+    """Move chunks between processes through a ring of shared memory slots.
+
+    The producer copies a chunk straight into a free slot, and only the
+    slot number and metadata are sent through a pipe, so the chunk is
+    neither pickled nor copied through the pipe. The consumer reads the
+    slot in place, and the slot is returned to the free list on the next
+    get, so a view must not be used beyond that. Producers take slots from
+    the free list, so several may share the transport.
+
+    The ring holds the bytes allowed in flight, as at least MINSLOTS slots
+    of at most SLOTSIZE. A chunk which does not fit a slot is sent through
+    the pipe instead, but holds the slots it would fill, or every slot, so
+    it still counts against the bound.
+    """
+
+    MINSLOTS = 2
+    SLOTSIZE = 2 * 1024 * 1024  # 2MB
+
+    def __init__(self, ctx, max_bytes):
+        self._slot_size = max(1, min(self.SLOTSIZE,
+                                     max_bytes // self.MINSLOTS))
+        self._slots = max(self.MINSLOTS, max_bytes // self._slot_size)
+        self._shm = shared_memory.SharedMemory(
+            create=True, size=self._slots * self._slot_size)
+        self._free = ctx.SimpleQueue()
+        for slot in range(self._slots):
+            self._free.put(slot)
+
+        # slots are taken one at a time, so only one producer may gather
+        # several at once, or two could each wait on what the other holds
+        self._gathering = ctx.Lock()
+        self._messages = ctx.SimpleQueue()
+        self._held = []
+        self._views = []
+
+    def put(self, parts, meta):
+        """Send the concatenation of bytes parts with its metadata."""
+        nbytes = sum(len(part) for part in parts)
+        if nbytes == 0:
+            self._messages.put(((), 0, b'', meta))
+            return
+
+        if nbytes > self._slot_size:
+            needed = min(self._slots, -(-nbytes // self._slot_size))
+            with self._gathering:
+                slots = tuple(self._free.get() for _ in range(needed))
+            self._messages.put((slots, nbytes, b''.join(parts), meta))
+            return
+
+        # blocks until the consumer returns a slot
+        slot = self._free.get()
+
+        offset = slot * self._slot_size
+        buf = self._shm.buf
+        for part in parts:
+            buf[offset:offset + len(part)] = part
+            offset += len(part)
+
+        self._messages.put(((slot, ), nbytes, None, meta))
+
+    def mark(self, marker):
+        """Send a marker, such as READ_COMPLETE, in place of a chunk."""
+        self._messages.put(marker)
+
+    def complete(self):
+        self.mark(READ_COMPLETE)
 
-        reader.join()
-        writer.join()
+    def release(self):
+        """Return what the last get holds, e.g. once the consumer is done.
 
+        The segment cannot be closed while the consumer holds views of it.
+        """
+        for view in self._views:
+            view.release()
+        for slot in self._held:
+            self._free.put(slot)
+        self._views = []
+        self._held = []
+
+    def _received(self, msg):
+        if msg in MARKERS:
+            return msg
+
+        # a chunk sent through the pipe comes with its data
+        slots, nbytes, data, meta = msg
+        self._held.extend(slots)
+        if data is not None:
+            return data, meta
+
+        offset = slots[0] * self._slot_size
+        view = self._shm.buf[offset:offset + nbytes]
+        self._views.append(view)
+        return view, meta
+
+    def get(self):
+        self.release()
+        return self._received(self._messages.get())
 
-class BufferedQueue:
-    """Implement a buffered shared queue.
+    def get_many(self, limit):
+        """Get a message, and whichever follow it without waiting.
 
-    multiprocessing.Queue has an OS dependent max size, which can be
-    unexpectedly small, see https://github.com/python/cpython/issues/119534.
-    To adjust for this, we're increasing the amount of data which an
-    individual queue item can hold.
+        At most limit messages are returned, and none after a marker.
+        Their slots are all held until the next get.
+        """
+        msgs = [self.get()]
+        while len(msgs) < limit and msgs[-1] not in MARKERS and \
+                not self._messages.empty():
+            msgs.append(self._received(self._messages.get()))
+        return msgs
+
+    def close(self):
+        """Release the shared memory, which only the creator should do."""
+        self.release()
+        self._shm.close()
+        self._shm.unlink()
+
+
+def _batch_mxfiles(file_map, batch):
+    """Get the MuxFiles of a batch, or of a range of batches.
+
+    A range streams its batches consecutively, and their records keep the
+    tags of their own batch, so partials are still produced per batch.
     """
+    if isinstance(batch, int):
+        return file_map.batch(batch)
+    else:
+        return file_map.batches(batch)
+
+
+def _validate_transport(transport, max_buffer_mb):
+    if transport not in (QUEUE, SHM):
+        raise ValueError(f"Unknown transport: {transport}")
+    if max_buffer_mb < 1:
+        raise ValueError("max_buffer_mb must be at least 1")
+    return transport, max_buffer_mb * 1024 * 1024
+
+
+def _validate_pipe_size(pipe_size_mb):
+    if pipe_size_mb < 0:
+        raise ValueError("pipe_size_mb cannot be negative")
+    return pipe_size_mb * 1024 * 1024
+
+
+def _validate_readers(readers, reader_order, n_mxfiles):
+    if readers < 1:
+        raise ValueError("readers must be at least 1")
+    if reader_order not in (FILE_ORDER, ARRIVAL):
+        raise ValueError(f"Unknown reader order: {reader_order}")
 
-    BUFSIZE = 128
+    # a reader without files would have nothing to do
+    readers = max(1, min(readers, n_mxfiles))
+    return readers, reader_order == FILE_ORDER and readers > 1
 
-    def __init__(self, ctx):
-        self._queue = ctx.Queue(maxsize=min(32767, SEM_VALUE_MAX))
-        self._buf = None
+
+def _validate_engine(engine, start_method):
+    if engine not in (THREADS, PROCESSES):
+        raise ValueError(f"Unknown engine: {engine}")
+    if start_method not in mp.get_all_start_methods():
+        raise ValueError(f"Unsupported start method: {start_method}")
+    return engine, start_method
+
+
+class _Value:
+    def __init__(self, value):
+        self.value = value
+
+
+class _Thread(threading.Thread):
+    def __init__(self, target):
+        super().__init__(target=target, daemon=True)
+        self._abandoned = False
+        self.exitcode = None
+
+        # like a process sentinel, this is ready once the thread has ended
+        self.sentinel, self._done = mp.Pipe(duplex=False)
+
+    def run(self):
+        try:
+            super().run()
+            self.exitcode = 0
+        except BaseException:
+            # report as a failed process would, and leave it to supervision
+            self.exitcode = 1
+            traceback.print_exc()
+        finally:
+            self._done.close()
+
+    def terminate(self):
+        # a thread cannot be killed, so we stop waiting on it instead. it
+        # is a daemon, so it does not hold the interpreter open
+        self._abandoned = True
+
+    def join(self, timeout=None):
+        if not self._abandoned:
+            super().join(timeout)
+
+        # as a process does once joined, release the sentinel, which we no
+        # longer watch once a thread is abandoned
+        if self._abandoned or not self.is_alive():
+            self.sentinel.close()
+
+
+class ThreadContext:
+    """Provide the parts of a multiprocessing context we use, with threads.
+
+    The read and write stages run as threads of the calling process, so
+    nothing is pickled and no interpreter is started. The GIL is shared,
+    which is cheap when the stages are dominated by (de)compression that
+    releases it, and costly when both are parsing or formatting.
+    """
+
+    Queue = staticmethod(queue.Queue)
+    Pipe = staticmethod(mp.Pipe)
+    SimpleQueue = staticmethod(queue.SimpleQueue)
+    Condition = staticmethod(threading.Condition)
+    Lock = staticmethod(threading.Lock)
+
+    @staticmethod
+    def Value(typecode, value, lock=True):
+        return _Value(value)
+
+    @staticmethod
+    def Process(target):
+        return _Thread(target)
+
+
+def _supervise(name, stages, messages):
+    """Wait on stages, and their messages, until completion or failure.
+
+    The last stage, the writer, reports completion, and True is returned
+    once it does. If a stage reports an error, every stage is terminated and
+    False is returned. If a stage exits unsuccessfully without reporting,
+    every stage is terminated and RuntimeError is raised, as it is if every
+    stage exits without the writer reporting completion.
+    """
+    running = {stage.sentinel: stage for stage in stages}
+    failed = None
+    terminate = False
+    while True:
+        ready = wait([messages] + list(running))
+
+        if messages in ready:
+            msg = messages.recv()
+            if msg == COMPLETE:
+                break
+            elif msg == ERROR:
+                print(f"Error received in {name}; terminating",
+                      file=sys.stderr, flush=True)
+                terminate = True
+                break
+
+        for sentinel in ready:
+            stage = running.pop(sentinel, None)
+            if stage is None:
+                continue
+
+            stage.join()
+            if stage.exitcode != 0:
+                failed = stage
+
+        if failed is not None:
+            print(f"A stage of {name} exited with {failed.exitcode}; "
+                  "terminating", file=sys.stderr, flush=True)
+            terminate = True
+            break
+
+        if not running and not messages.poll():
+            # everything ended cleanly without a word, so the writer
+            # returned without completing
+            failed = stages[-1]
+            print(f"The writer of {name} exited without reporting "
+                  "completion", file=sys.stderr, flush=True)
+            break
+
+    for stage in stages:
+        if terminate:
+            stage.terminate()
+        stage.join()
+
+    if failed is not None:
+        raise RuntimeError(f"{name} failed")
+
+    return not terminate
+
+
+def _get_context(engine, start_method=SPAWN):
+    if engine == THREADS:
+        return ThreadContext()
+
+    ctx = mp.get_context(start_method)
+    if start_method == FORKSERVER:
+        # children are forked from a server which has already imported us,
+        # and with us polars and numpy, so they start without importing
+        ctx.set_forkserver_preload(FORKSERVER_PRELOAD)
+    return ctx
+
+
+def _make_transport(ctx, transport, max_bytes):
+    if transport == QUEUE:
+        return QueueTransport(ctx, max_bytes)
+    else:
+        return SharedMemoryTransport(ctx, max_bytes)
+
+
+class ChunkedQueue:
+    """Implement a shared queue of serialized records.
+
+    Records are serialized by the producer and shipped in large bytes
+    chunks, so the consumer does a single write per chunk rather than
+    unpickling and formatting every record. Each chunk carries an index of
+    (key, end offset) pairs, one per run of consecutive records placed with
+    the same key, so a consumer can route runs of records without parsing.
+
+    A chunk is placed once it reaches a size threshold, or once its first
+    record has waited for the deadline, so a slow producer does not hold
+    records back from the consumer. The threshold is tuned from the
+    observed rate of production to roughly what is produced within the
+    deadline, bounded by MINCHUNKSIZE and CHUNKSIZE. The deadline is only
+    checked as records are placed, so a producer which may wait on its
+    input should flush before doing so.
+    """
+
+    MINCHUNKSIZE = 64 * 1024  # 64KB
+    CHUNKSIZE = 1024 * 1024  # 1MB
+    DEADLINE = 0.005  # 5ms
+
+    def __init__(self, transport):
+        self._transport = transport
+        self._runs = None
+        self._size = 0
+        self._started = None
+        self._held = False
+        self._threshold = self.MINCHUNKSIZE
         self._init_buf()
 
     def _init_buf(self):
-        self._buf = deque(maxlen=self.BUFSIZE)
+        self._runs = []
+        self._size = 0
+
+    def _tune(self, size, elapsed):
+        # aim for what we would produce within the deadline, and smooth
+        # so a single stall or burst does not swing the threshold
+        if elapsed > 0:
+            target = size / elapsed * self.DEADLINE
+        else:
+            target = self.CHUNKSIZE
+
+        target = (self._threshold + target) / 2
+        self._threshold = int(min(max(target, self.MINCHUNKSIZE),
+                                  self.CHUNKSIZE))
 
     def _place_buf(self):
-        if len(self._buf) > 0:
-            buf = tuple(self._buf)
-            self._queue.put(buf)
-            self._init_buf()
-
-    def put(self, item):
-        # if we receive a thread complete signal, make sure we drain our
-        # buffer before passing on the completion message
-        if item == READ_COMPLETE:
-            self._place_buf()
-            self._queue.put(READ_COMPLETE)
+        if self._size == 0:
+            return
+
+        self._tune(self._size, time.monotonic() - self._started)
+
+        # encode each run at once, noting where it ends in the chunk
+        encoded = []
+        index = []
+        end = 0
+        for key, parts in self._runs:
+            data = ''.join(parts).encode('utf-8')
+            end += len(data)
+            encoded.append(data)
+            index.append((key, end))
+
+        self._transport.put(encoded, tuple(index))
+        self._init_buf()
+
+    def put(self, data, key=None, hold=False):
+        """Place a serialized record, optionally keyed for routing.
+
+        With hold, the chunk is not placed before the next record, so the
+        two travel together, e.g. the mates of a pair. A chunk is placed
+        regardless once it reaches twice CHUNKSIZE.
+        """
+        now = time.monotonic()
+        if self._size == 0:
+            self._started = now
+
+        if self._runs and self._runs[-1][0] == key:
+            self._runs[-1][1].append(data)
         else:
-            self._buf.append(item)
+            self._runs.append((key, [data]))
+
+        self._size += len(data)
+        self._held = hold
+        if hold and self._size < 2 * self.CHUNKSIZE:
+            return
+
+        if self._size >= self._threshold or \
+                now - self._started >= self.DEADLINE:
+            self._place_buf()
+
+    def flush(self):
+        """Place what is buffered, unless the last record was held."""
+        if not self._held:
+            self._place_buf()
+
+    def file_complete(self):
+        """Drain what is buffered, and mark the end of a file."""
+        self._place_buf()
+        self._transport.mark(FILE_COMPLETE)
 
-            if len(self._buf) == self.BUFSIZE:
-                self._place_buf()
+    def complete(self):
+        """Drain what is buffered, and signal there is nothing further."""
+        self._place_buf()
+        self._transport.complete()
 
     def get(self):
-        return self._queue.get()
+        return self._transport.get()
 
+    def get_many(self, limit):
+        return self._transport.get_many(limit)
 
-class Demultiplex:
+    def release(self):
+        self._transport.release()
+
+    def close(self):
+        self._transport.close()
+
+
+def _reader_queues(transports, readers):
+    # each reader keeps its own ChunkedQueue, as it holds a partial chunk,
+    # and the readers are dealt the transports in turn
+    return [ChunkedQueue(transports[reader % len(transports)])
+            for reader in range(readers)]
+
+
+def _shared_messages(chunked_queue, readers, limit=1):
+    """Yield lists of the messages of readers which share a transport.
+
+    Each reader completes in turn, and we are done once all of them have.
+    """
+    remaining = readers
+    while remaining:
+        msgs = chunked_queue.get_many(limit)
+        if msgs[-1] == READ_COMPLETE:
+            msgs.pop()
+            remaining -= 1
+        yield msgs
+
+
+class Demultiplex(_PickledWithoutFileMap):
     def __init__(self, file_map, batch, paired_handling, mux_input,
-                 output_base, extension):
+                 output_base, extension, compression_threads=1,
+                 bgzf=False, partial_extension=None, compression_level=None,
+                 partial_compression_level=None, zstd_dict=None,
+                 transport=QUEUE, max_buffer_mb=MAX_BUFFER_MB,
+                 engine=PROCESSES, start_method=SPAWN,
+                 pipe_size_mb=PIPE_SIZE_MB, allow_empty=False):
         self._file_map = file_map
         self._batch = batch
-        self._mxfiles = file_map.batch(batch)
+        self._mxfiles = _batch_mxfiles(file_map, batch)
+        self._pipe_size = _validate_pipe_size(pipe_size_mb)
         self._tag_lookup = {mx.tag: mx for mx in self._mxfiles}
         self._valid_tags = frozenset(self._tag_lookup)
         self._paired_handling = paired_handling
+        self._transport, self._max_buffer = _validate_transport(
+            transport, max_buffer_mb)
+        self._engine, self._start_method = _validate_engine(engine,
+                                                            start_method)
         self._output_base = output_base
         self._extension = extension
-        self._open_f = IO.opener(self._extension)
-        self._mux_input = mux_input
+        self._codec = OutputCodec(extension, compression_threads,
+                                  compression_level, bgzf, zstd_dict)
+
+        # partials are recompressed on consolidation, so they can be written
+        # cheaply and the expensive compression left for later
+        if partial_extension is None and partial_compression_level is None:
+            self._partial_extension = extension
+            self._partial_codec = self._codec
+        else:
+            if partial_extension is None:
+                partial_extension = extension
+            self._partial_extension = partial_extension
+            self._partial_codec = OutputCodec(partial_extension,
+                                              compression_threads,
+                                              partial_compression_level,
+                                              zstd_dict=zstd_dict)
+        # several streams, e.g. from shards of a tool, are each read by
+        # their own reader, and written by a single writer
+        if isinstance(mux_input, list):
+            self._mux_inputs = mux_input
+        else:
+            self._mux_inputs = [mux_input]
+
+        # an empty stream usually means upstream bailed, unless the caller
+        # knows otherwise, e.g. a tool which found nothing to report
+        self._allow_empty = allow_empty
 
         if not file_map.is_paired:
             if self._paired_handling in (R2ONLY, MERGE):
                 raise ValueError("Data are not paired")
 
-        self.queue = None
+        self._chunked_queues = None
         self._open_files = {}
+        self._nbytes = None
+
+    @property
+    def nbytes(self):
+        """The bytes demultiplexed by the last start, before compression."""
+        return 0 if self._nbytes is None else self._nbytes.value
 
     def __del__(self):
         self._close_files()
@@ -240,77 +986,104 @@ class Demultiplex:
                 v.close()
 
     def start(self):
-        """Start the Demultiplexing."""
-        ctx = mp.get_context('spawn')
-        self.buffered_queue = BufferedQueue(ctx)
-        self.msg_queue = ctx.Queue(maxsize=16)
+        """Start the Demultiplexing, returning whether it completed."""
+        ctx = _get_context(self._engine, self._start_method)
+        transport = _make_transport(ctx, self._transport, self._max_buffer)
 
-        reader = ctx.Process(target=self.read)
+        self._chunked_queues = _reader_queues([transport],
+                                              len(self._mux_inputs))
+        self._nbytes = ctx.Value('q', 0, lock=False)
+        messages, self.msg_pipe = ctx.Pipe(duplex=False)
+
+        readers = [ctx.Process(target=partial(self.read, reader))
+                   for reader in range(len(self._mux_inputs))]
         writer = ctx.Process(target=self.write)
 
-        reader.start()
+        for reader in readers:
+            reader.start()
         writer.start()
 
-        while True:
-            time.sleep(0.1)
-            if self.msg_queue.empty():
-                continue
-
-            msg = self.msg_queue.get()
-
-            if msg == ERROR:
-                print(f"Error received in {self.__class__}; terminating",
-                      file=sys.stderr, flush=True)
-                reader.terminate()
-                writer.terminate()
-                break
-            elif msg == COMPLETE:
-                break
-
-        reader.join()
-        writer.join()
+        try:
+            return _supervise(self.__class__, readers + [writer], messages)
+        finally:
+            messages.close()
+            self.msg_pipe.close()
+            transport.close()
 
-    def read(self):
-        """Read from the input stream and queue."""
+    def _open_mux_input(self, mux_input, on_idle):
         # we can't pickle the streams so this has to be thread local
-        if self._mux_input == '-':
+        if mux_input == '-':
             # see https://docs.python.org/3/library/multiprocessing.html#programming-guidelines
-            # stdin is closed to avoid mangling, so we explicitly open it again
-            mux_input = open(0, 'rt')
-        elif isinstance(self._mux_input, io.StringIO):
-            mux_input = self._mux_input
+            # stdin is closed to avoid mangling, so we explicitly open it again.
+            # a thread shares stdin with its caller, so must not close it
+            return self._open_pipe(0, on_idle, self._engine != THREADS)
+        elif isinstance(mux_input, PipeEnd):
+            # a pipe we were handed, which we read as we would stdin
+            return self._open_pipe(mux_input.fd, on_idle, False)
+        elif isinstance(mux_input, io.StringIO):
+            return mux_input
         else:
-            mux_input = open(self._mux_input, 'rt')
+            # a staged stream may have been compressed by mux --output
+            return IO.open_input(mux_input)
+
+    def _open_pipe(self, fd, on_idle, closefd):
+        # a larger pipe, and a read buffer to match, lets us drain more
+        # of what upstream has produced with each read. what is buffered
+        # is passed on before we wait for upstream, as it may be some time
+        grow_pipe(fd, self._pipe_size)
+        raw = IdleReader(fd, on_idle, closefd)
+        buffered = io.BufferedReader(raw, max(self._pipe_size,
+                                              io.DEFAULT_BUFFER_SIZE))
+        return io.TextIOWrapper(buffered)
+
+    def read(self, worker=0):
+        """Read from an input stream and queue."""
+        chunked_queue = self._chunked_queues[worker]
+        mux_input = self._open_mux_input(self._mux_inputs[worker],
+                                         chunked_queue.flush)
 
         try:
             sniffed, read_f, _ = IO.io_from_stream(mux_input)
         except StopIteration:
-            # stream is empty, upstream program likely bailed
-            self._terminate()
+            if self._allow_empty:
+                chunked_queue.complete()
+            else:
+                # stream is empty, upstream program likely bailed
+                self._terminate()
             return
 
         mux_input = sniffed
 
+        # route each record by its tag and orientation, so the writer does
+        # not need to parse the records itself
+        valid_tags = self._valid_tags
+
+        # the writer takes chunks from several streams as they arrive, so
+        # an R1 is kept in the chunk of its mate, or the R1 and R2 outputs
+        # could receive the pairs of two streams in different orders
+        sharded = len(self._mux_inputs) > 1
         for rec in read_f(mux_input):
-            self.buffered_queue.put(rec)
+            tag, rec = rec.detag(valid_tags)
+            orientation = rec.get_orientation()
+            chunked_queue.put(rec.write(), (tag, orientation),
+                              hold=sharded and orientation == R1)
 
-        self._read_complete()
+        chunked_queue.complete()
 
     def _terminate(self):
-        self.msg_queue.put(ERROR)
-
-    def _read_complete(self):
-        self.buffered_queue.put(READ_COMPLETE)
+        self.msg_pipe.send(ERROR)
 
     def _write_complete(self):
-        self.msg_queue.put(COMPLETE)
+        self.msg_pipe.send(COMPLETE)
 
     @lru_cache()
     def _get_output_path(self, mx, orientation):
         if mx.complete:
             prefix = ''
+            extension = self._extension
         else:
             prefix = f'{PARTIAL}.{mx.tag}.'
+            extension = self._partial_extension
 
         if self._paired_handling == MERGE:
             base = os.path.basename(mx.file1)
@@ -324,48 +1097,67 @@ class Demultiplex:
         else:
             raise ValueError("Unsupported pairing mode")
 
-        return f"{self._output_base}/{prefix}{base}.{self._extension}"
+        return f"{self._output_base}/{prefix}{base}.{extension}"
 
-    def _get_opened_file(self, path, mode='wt'):
+    def _get_opened_file(self, path, codec, mode='wb'):
         if path not in self._open_files:
-            self._open_files[path] = self._open_f(path, mode)
+            self._open_files[path] = codec.open(path, mode)
 
         return self._open_files[path]
 
-    def _write_rec(self, mx, rec):
-        out_path = self._get_output_path(mx, rec.get_orientation())
-        out_f = self._get_opened_file(out_path)
-        out_f.write(rec.write())
+    def _write_run(self, mx, orientation, data):
+        out_path = self._get_output_path(mx, orientation)
+        codec = self._codec if mx.complete else self._partial_codec
+        out_f = self._get_opened_file(out_path, codec)
+        out_f.write(data)
 
     def write(self):
         """Write to the respective outputs."""
         default = MuxFile("badtag.r1", "badtag.r2", 0, sys.maxsize, "badtag",
                           False)
-
-        while True:
-            # get a block of records
-            recs = self.buffered_queue.get()
-
-            # if we are complete then terminate gracefully
-            if recs == READ_COMPLETE:
-                break
-
-            # otherwise, write each record
-            for rec in recs:
-                tag, rec = rec.detag(self._valid_tags)
-                mx = self._tag_lookup.get(tag, default)
-                self._write_rec(mx, rec)
-
+        nbytes = 0
+
+        # write each run of serialized records to its output
+        for msgs in _shared_messages(self._chunked_queues[0],
+                                     len(self._mux_inputs)):
+            for chunk, index in msgs:
+                nbytes += len(chunk)
+                view = memoryview(chunk)
+                start = 0
+                for (tag, orientation), end in index:
+                    mx = self._tag_lookup.get(tag, default)
+                    self._write_run(mx, orientation, view[start:end])
+                    start = end
+
+        # make sure everything is flushed before we report completion
+        self._nbytes.value = nbytes
+        self._close_files()
+        self._codec.close()
+        self._partial_codec.close()
         self._write_complete()
 
 
 class Consolidate:
     BUFSIZE = 1024 * 1024  # 1MB
 
-    def __init__(self, output_base, extension):
+    def __init__(self, output_base, extension, gzip_backend=None,
+                 compression_threads=1, bgzf=False, partial_extension=None,
+                 compression_level=None, zstd_dict=None, transport=QUEUE,
+                 max_buffer_mb=MAX_BUFFER_MB, engine=PROCESSES,
+                 start_method=SPAWN):
         self._output_base = output_base
+        self._transport, self._max_buffer = _validate_transport(
+            transport, max_buffer_mb)
+        self._engine, self._start_method = _validate_engine(engine,
+                                                            start_method)
         self._extension = extension
-        self._open_f = IO.opener(self._extension)
+        if partial_extension is None:
+            partial_extension = extension
+        self._partial_extension = partial_extension
+        self._codec = OutputCodec(extension, compression_threads,
+                                  compression_level, bgzf, zstd_dict)
+        self._zstd_dict = zstd_dict
+        self._gzip_backend = resolve_gzip_backend(gzip_backend)
         self._groups = []
         self._init()
 
@@ -378,13 +1170,17 @@ class Consolidate:
         return tag, fp[len(tag) + 1:]
 
     def _init(self):
-        files = glob.glob(f"{self._output_base}/*{self._extension}")
+        suffix = f".{self._partial_extension}"
+        files = glob.glob(f"{self._output_base}/{PARTIAL}.*{suffix}")
         current_files = [os.path.basename(f) for f in files]
 
         partials = defaultdict(list)
         for fp in current_files:
             if fp.startswith(PARTIAL):
                 tag, untagged = self._tag_from_file(fp)
+
+                # partials may be stored differently than the final output
+                untagged = f"{untagged[:-len(suffix)]}.{self._extension}"
                 if os.path.exists(f"{self._output_base}/{untagged}"):
                     raise IOError(f"Non-partial '{untagged}' unexpectedly exists")
 
@@ -404,12 +1200,15 @@ class Consolidate:
         for out_f, files_to_read in self._groups:
             out_path = f"{self._output_base}/{out_f}"
 
-            self.queue.put((PATH, out_path))
+            self.queue.put([], (PATH, out_path))
             for fp in files_to_read:
-                for block in self._bulk_read(self._open_f(fp, 'rb')):
-                    self.queue.put((DATA, block))
+                with open(fp, 'rb') as raw, \
+                        IO.decompressed(raw, gzip_backend=self._gzip_backend,
+                                        zstd_dict=self._zstd_dict) as data:
+                    for block in self._bulk_read(data):
+                        self.queue.put([block], (DATA, None))
 
-        self.queue.put(READ_COMPLETE)
+        self.queue.complete()
 
     def write(self):
         current_handle = None
@@ -421,12 +1220,12 @@ class Consolidate:
             if msg == READ_COMPLETE:
                 break
             else:
-                dtype, data = msg
+                data, (dtype, path) = msg
 
             if dtype == PATH:
                 if current_handle is not None:
                     current_handle.close()
-                current_handle = self._open_f(data, 'wb')
+                current_handle = self._codec.open(path, 'wb')
             elif dtype == DATA:
                 current_handle.write(data)
             else:
@@ -434,17 +1233,20 @@ class Consolidate:
 
         if current_handle is not None:
             current_handle.close()
+        self._codec.close()
+        self.msg_pipe.send(COMPLETE)
 
     def _work_to_do(self):
         return len(self._groups) > 0
 
     def start(self):
-        """Start the Consolidating."""
+        """Start the Consolidating, returning whether it completed."""
         if not self._work_to_do():
-            return
+            return True
 
-        ctx = mp.get_context('spawn')
-        self.queue = ctx.Queue(maxsize=128)
+        ctx = _get_context(self._engine, self._start_method)
+        self.queue = _make_transport(ctx, self._transport, self._max_buffer)
+        messages, self.msg_pipe = ctx.Pipe(duplex=False)
 
         reader = ctx.Process(target=self.read)
         writer = ctx.Process(target=self.write)
@@ -452,5 +1254,9 @@ class Consolidate:
         reader.start()
         writer.start()
 
-        reader.join()
-        writer.join()
+        try:
+            return _supervise(self.__class__, [reader, writer], messages)
+        finally:
+            messages.close()
+            self.msg_pipe.close()
+            self.queue.close()
@@ -0,0 +1,149 @@
+"""Helpers for moving data through pipes and file descriptors."""
+import io
+import os
+import sys
+import stat
+import array
+import select
+from multiprocessing.reduction import DupFd
+
+try:
+    import fcntl
+    import termios
+except ImportError:  # pragma: no cover
+    fcntl = None
+    termios = None
+
+# linux only, and the limit for unprivileged processes is in pipe-max-size
+F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', None)
+PIPE_MAX_SIZE = '/proc/sys/fs/pipe-max-size'
+
+# the most buffers a single writev accepts
+IOV_MAX = os.sysconf('SC_IOV_MAX') if hasattr(os, 'sysconf') else 16
+
+
+def is_pipe(fd):
+    """Test whether a file descriptor is a pipe."""
+    try:
+        return stat.S_ISFIFO(os.fstat(fd).st_mode)
+    except OSError:
+        return False
+
+
+def _pipe_max_size():
+    try:
+        with open(PIPE_MAX_SIZE) as fp:
+            return int(fp.read())
+    except (OSError, ValueError):
+        return None
+
+
+def grow_pipe(fd, size):
+    """Raise the capacity of a pipe.
+
+    The size is capped to what an unprivileged process may set. Returns
+    the resulting capacity, or None if the descriptor is not a pipe or the
+    capacity cannot be changed on this platform.
+    """
+    if size <= 0 or F_SETPIPE_SZ is None or not sys.platform.startswith(
+            'linux') or not is_pipe(fd):
+        return None
+
+    limit = _pipe_max_size()
+    if limit is not None:
+        size = min(size, limit)
+
+    try:
+        return fcntl.fcntl(fd, F_SETPIPE_SZ, size)
+    except OSError:
+        return None
+
+
+def pipe_queued(fd):
+    """Get the bytes waiting to be read from a pipe, from either end.
+
+    Returns None if this cannot be determined on this platform.
+    """
+    if termios is None or not hasattr(termios, 'FIONREAD'):
+        return None
+
+    queued = array.array('i', [0])
+    try:
+        fcntl.ioctl(fd, termios.FIONREAD, queued)
+    except OSError:
+        return None
+    return queued[0]
+
+
+def write_all(fd, buffers):
+    """Write buffers to a file descriptor, using as few calls as we can.
+
+    Buffers are written with os.writev, resuming after partial writes as
+    a pipe may accept less than was offered.
+    """
+    views = [memoryview(buf) for buf in buffers if len(buf) > 0]
+    first = 0
+    while first < len(views):
+        written = os.writev(fd, views[first:first + IOV_MAX])
+
+        # skip what was written completely, and trim what was not
+        while written > 0:
+            size = views[first].nbytes
+            if written >= size:
+                first += 1
+                written -= size
+            else:
+                views[first] = views[first][written:]
+                written = 0
+
+
+class IdleReader(io.RawIOBase):
+    """Read a file descriptor, calling back before a read would block.
+
+    A consumer which batches what it reads can use the callback to pass on
+    what it holds, rather than keep it while upstream is quiet.
+    """
+
+    def __init__(self, fd, on_idle, closefd=True):
+        self._fd = fd
+        self._on_idle = on_idle
+        self._closefd = closefd
+
+    def readable(self):
+        return True
+
+    def fileno(self):
+        return self._fd
+
+    def readinto(self, buf):
+        readable, _, _ = select.select([self._fd], [], [], 0)
+        if not readable:
+            self._on_idle()
+        return os.readv(self._fd, [buf])
+
+    def close(self):
+        if not self.closed and self._closefd:
+            os.close(self._fd)
+        super().close()
+
+
+class PipeEnd:
+    """A file descriptor which can be handed to a stage.
+
+    A stage in another process receives its own duplicate of the
+    descriptor, however the process was started. The descriptor is owned by
+    whoever created it, and is not closed here.
+    """
+
+    def __init__(self, fd):
+        self.fd = fd
+
+    def __reduce__(self):
+        return _rebuild_pipe_end, (DupFd(self.fd), )
+
+    def __repr__(self):
+        return f"PipeEnd({self.fd})"
+
+
+def _rebuild_pipe_end(dup):
+    return PipeEnd(dup.detach())
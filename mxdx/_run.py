@@ -0,0 +1,260 @@
+import os
+import sys
+import time
+import signal
+import threading
+import subprocess
+from contextlib import nullcontext
+
+from ._mxdx import (Multiplex, Demultiplex, MAX_BUFFER_MB, PIPE_SIZE_MB)
+from ._pipe import grow_pipe, PipeEnd
+from ._constants import (SEQUENTIAL, SEPARATE, QUEUE, PROCESSES, SPAWN, FORK,
+                         ROUND_ROBIN, MUX, TOOL, DEMUX)
+
+
+class Run:
+    """Multiplex a batch through a tool, and demultiplex what it emits.
+
+    The tool is started as a subprocess. Multiplex writes to its stdin, and
+    Demultiplex reads its stdout, through pipes we own, so the file map is
+    read once and the three stages are supervised together. A stage which
+    fails stops the tool, and every stage which failed is reported.
+
+    With several shards, as many copies of the tool are started. Chunks of
+    records are dealt across them, in turn or by load, and their outputs
+    are read concurrently into the same outputs, so the order of records
+    within an output follows the order in which the shards emit them.
+    """
+
+    def __init__(self, file_map, batch, command, output_base, extension,
+                 mux_paired_handling=SEQUENTIAL,
+                 demux_paired_handling=SEPARATE, transport=QUEUE,
+                 max_buffer_mb=MAX_BUFFER_MB, engine=PROCESSES,
+                 start_method=SPAWN, pipe_size_mb=PIPE_SIZE_MB, shards=1,
+                 distribution=ROUND_ROBIN, mux_options=None,
+                 demux_options=None):
+        if not command:
+            raise ValueError("A command to run is required")
+        if shards < 1:
+            raise ValueError("shards must be at least 1")
+
+        # the mates of a pair must reach the same shard, and come back
+        # together, which a sequential stream cannot do
+        if shards > 1 and file_map.is_paired and \
+                mux_paired_handling == SEQUENTIAL:
+            raise ValueError("Paired data must be interleaved to be sharded")
+
+        # a forked stage would hold the other stage's end of the tool's
+        # pipes, so the tool would never see the end of its input
+        if engine == PROCESSES and start_method == FORK:
+            raise ValueError("Processes cannot be forked for run")
+
+        self._command = list(command)
+        self._shards = shards
+        self._pipe_size = pipe_size_mb * 1024 * 1024
+        self._stdin = None
+        self._stdout = None
+        self._reaping = threading.Lock()
+        self.metrics = None
+
+        # the tool's pipes are made by start, which gives these their
+        # descriptors, so nothing is held open until we run
+        self._mux_outputs = [PipeEnd(None) for _ in range(shards)]
+        self._demux_inputs = [PipeEnd(None) for _ in range(shards)]
+        if shards == 1:
+            mux_output = self._mux_outputs[0]
+            demux_input = self._demux_inputs[0]
+        else:
+            mux_output = self._mux_outputs
+            demux_input = self._demux_inputs
+
+        common = {'transport': transport, 'max_buffer_mb': max_buffer_mb,
+                  'engine': engine, 'start_method': start_method,
+                  'pipe_size_mb': pipe_size_mb}
+        self._mux = Multiplex(file_map, batch, mux_paired_handling,
+                              mux_output, distribution=distribution,
+                              **common, **(mux_options or {}))
+
+        # we know whether the tool failed, so an empty output only means it
+        # had nothing to report
+        self._demux = Demultiplex(file_map, batch, demux_paired_handling,
+                                  demux_input, output_base, extension,
+                                  allow_empty=True, **common,
+                                  **(demux_options or {}))
+
+    def _close(self, *fds):
+        for fd in fds:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def _make_pipes(self):
+        """Make the stdin and stdout pipes of each shard."""
+        pipes = []
+        try:
+            for _ in range(2 * self._shards):
+                pipes.append(os.pipe())
+        except OSError:
+            for pair in pipes:
+                self._close(*pair)
+            raise
+
+        self._stdin = pipes[:self._shards]
+        self._stdout = pipes[self._shards:]
+        for end, (_, stdin_w) in zip(self._mux_outputs, self._stdin):
+            end.fd = stdin_w
+        for end, (stdout_r, _) in zip(self._demux_inputs, self._stdout):
+            end.fd = stdout_r
+
+    def _tool_name(self, shard):
+        if self._shards == 1:
+            return TOOL
+        return f"{TOOL}.{shard}"
+
+    def _stop_tools(self, tools):
+        # only _reap reaps a tool, as polling here could reap it first
+        with self._reaping:
+            for tool in tools:
+                if tool.returncode is None:
+                    try:
+                        os.kill(tool.pid, signal.SIGTERM)
+                    except ProcessLookupError:
+                        pass
+
+    def _reap(self, tool):
+        """Reap a tool once it exits, returning what it used."""
+        # where we can, wait without reaping, and reap while _stop_tools
+        # cannot run, so it never signals a pid which was reaped and reused
+        if hasattr(os, 'waitid'):
+            os.waitid(os.P_PID, tool.pid, os.WEXITED | os.WNOWAIT)
+            reaping = self._reaping
+        else:
+            reaping = nullcontext()
+
+        # wait4 gives us what the tool used, which Popen.wait does not
+        with reaping:
+            _, status, usage = os.wait4(tool.pid, 0)
+            tool.returncode = _exitcode(status)
+        return usage
+
+    def _run_stage(self, name, stage, fds, tools, results):
+        started = time.monotonic()
+        try:
+            completed = stage.start()
+        except Exception as e:
+            print(f"{name} failed: {e}", file=sys.stderr, flush=True)
+            completed = False
+        finally:
+            # release our ends, so the tool sees the end of its input, or a
+            # broken pipe if it has output no one will read
+            self._close(*fds)
+
+        ended = time.monotonic()
+        if not completed:
+            self._stop_tools(tools)
+
+        results[name] = {'seconds': ended - started,
+                         'nbytes': stage.nbytes,
+                         'completed': completed,
+                         'ended': ended}
+
+    def _wait_tool(self, name, tool, tools, started, results):
+        usage = self._reap(tool)
+        ended = time.monotonic()
+
+        # a tool which fails ends its shard, so stop the others too
+        completed = tool.returncode == 0
+        if not completed:
+            self._stop_tools(tools)
+
+        results[name] = {'seconds': ended - started,
+                         'returncode': tool.returncode,
+                         'user_seconds': usage.ru_utime,
+                         'system_seconds': usage.ru_stime,
+                         'max_rss_kb': usage.ru_maxrss,
+                         'completed': completed,
+                         'ended': ended}
+
+    def _start_tools(self):
+        tools = []
+        try:
+            for (stdin_r, _), (_, stdout_w) in zip(self._stdin, self._stdout):
+                tools.append(subprocess.Popen(self._command, stdin=stdin_r,
+                                              stdout=stdout_w))
+        except OSError as e:
+            # e.g. the tool does not exist, which is reported as any other
+            # failure of the run
+            self._stop_tools(tools)
+            for (_, stdin_w), (stdout_r, _) in zip(self._stdin, self._stdout):
+                self._close(stdin_w, stdout_r)
+            raise RuntimeError(f"{self.__class__.__name__} failed to start "
+                               f"{self._command[0]}: {e}") from e
+        finally:
+            # only the tools read their input and write their output
+            for (stdin_r, _), (_, stdout_w) in zip(self._stdin, self._stdout):
+                self._close(stdin_r, stdout_w)
+        return tools
+
+    def start(self):
+        """Start the tool and the stages around it, and wait on them all.
+
+        Returns the metrics of each stage, which are also kept in metrics.
+        The tool's metrics are a list, with an entry per shard. Raises
+        RuntimeError naming the stages which failed, in the order they
+        ended, or if the tool cannot be started.
+        """
+        started = time.monotonic()
+        self._make_pipes()
+        stdin_w = [w for _, w in self._stdin]
+        stdout_r = [r for r, _ in self._stdout]
+        for fd in stdin_w + stdout_r:
+            grow_pipe(fd, self._pipe_size)
+
+        tools = self._start_tools()
+
+        # each stage, and each shard of the tool, is waited on in a thread
+        # of its own, so we learn of a failure wherever it happens first
+        results = {}
+        tool_names = [self._tool_name(shard) for shard in range(len(tools))]
+        stages = [threading.Thread(target=self._run_stage,
+                                   args=(MUX, self._mux, stdin_w, tools,
+                                         results)),
+                  threading.Thread(target=self._run_stage,
+                                   args=(DEMUX, self._demux, stdout_r, tools,
+                                         results))]
+        stages += [threading.Thread(target=self._wait_tool,
+                                    args=(name, tool, tools, started,
+                                          results))
+                   for name, tool in zip(tool_names, tools)]
+        for stage in stages:
+            stage.start()
+        for stage in stages:
+            stage.join()
+
+        self.metrics = {MUX: results[MUX],
+                        TOOL: [results[name] for name in tool_names],
+                        DEMUX: results[DEMUX]}
+        self.metrics['seconds'] = time.monotonic() - started
+        failed = sorted((m['ended'], name) for name, m in results.items()
+                        if not m['completed'])
+        for m in results.values():
+            del m['ended']
+
+        if failed:
+            for name in tool_names:
+                if not results[name]['completed']:
+                    print(f"{name} exited with {results[name]['returncode']}",
+                          file=sys.stderr, flush=True)
+            names = ', '.join(name for _, name in failed)
+            raise RuntimeError(f"{self.__class__.__name__} failed in: {names}")
+
+        return self.metrics
+
+
+def _exitcode(status):
+    # as os.waitstatus_to_exitcode, which needs python 3.9, and as Popen
+    # reports it, negative for a signal
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
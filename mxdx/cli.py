@@ -2,11 +2,18 @@
 import click
 import sys
 import pathlib
+import itertools
+import json
 
-from ._io import FileMap
-from ._mxdx import Multiplex, Demultiplex, Consolidate
+from ._io import FileMap, IO
+from ._codec import GZIP_BACKENDS, AUTO, ZSTD_DICT_SIZE, train_zstd_dict
+from ._run import Run
+from ._mxdx import (Multiplex, Demultiplex, Consolidate, MAX_BUFFER_MB,
+                    PIPE_SIZE_MB)
 from ._constants import (INTERLEAVE, R1ONLY, R2ONLY, SEQUENTIAL,
-                         MERGE, SEPARATE)
+                         MERGE, SEPARATE, QUEUE, SHM, THREADS, PROCESSES,
+                         SPAWN, FORKSERVER, FORK, FILE_ORDER, ARRIVAL,
+                         ROUND_ROBIN, LOAD)
 
 @click.group()
 def cli():
@@ -14,44 +21,152 @@ def cli():
     pass
 
 
+def _options(*options):
+    """Combine click options into a single decorator, in the order given."""
+    def decorator(f):
+        for option in reversed(options):
+            f = option(f)
+        return f
+    return decorator
+
+
+_batch_options = _options(
+    click.option('--file-map', type=click.Path(exists=True), required=True,
+                 help="Files with record counts for processing"),
+    click.option('--batch', type=int, required=False, default=None,
+                 help="0-based index for batch offset"),
+    click.option('--batches', type=str, required=False, default=None,
+                 help=("An inclusive range of batches to stream "
+                       "consecutively, e.g. 10-19, instead of --batch")),
+    click.option('--batch-size', type=int, required=True,
+                 help="Number of records per batch"))
+
+_gzip_backend_option = click.option(
+    '--gzip-backend', type=click.Choice([AUTO] + list(GZIP_BACKENDS)),
+    default=None, required=False,
+    help=("How to decompress gzip data, by default from MXDX_GZIP_BACKEND "
+          "or automatically determined"))
+
+_reader_options = _options(
+    _gzip_backend_option,
+    click.option('--prefetch', type=click.IntRange(min=0), default=2,
+                 required=False, show_default=True,
+                 help="Number of upcoming files to open in the background"),
+    click.option('--readers', type=click.IntRange(min=1), default=1,
+                 required=False, show_default=True,
+                 help="Number of reader workers to distribute the files over"),
+    click.option('--reader-order', type=click.Choice([FILE_ORDER, ARRIVAL]),
+                 default=FILE_ORDER, required=False, show_default=True,
+                 help=("Whether to emit records from several readers in file "
+                       "order, or as their chunks arrive")))
+
+_compression_options = _options(
+    click.option('--compression-threads', type=click.IntRange(min=1),
+                 default=1, required=False, show_default=True,
+                 help="Number of threads to compress outputs with"),
+    click.option('--bgzf', is_flag=True, default=False,
+                 help=("Write gzip outputs as BGZF, with a .gzi index "
+                       "alongside")),
+    click.option('--compression-level', type=int, default=None,
+                 required=False,
+                 help="Compression level of outputs, by default per codec"),
+    click.option('--partial-extension', type=str, default=None,
+                 required=False,
+                 help=("The extension of partial files, which determines "
+                       "their compression, by default the same as "
+                       "--extension")),
+    click.option('--zstd-dict', type=click.Path(exists=True), default=None,
+                 required=False,
+                 help=("A dictionary from train-zstd-dict to compress zstd "
+                       "outputs with")))
+
+_partial_compression_level_option = click.option(
+    '--partial-compression-level', type=int, default=None, required=False,
+    help="Compression level of partial files, by default per codec")
+
+
+def _stage_options(start_methods=(SPAWN, FORKSERVER, FORK)):
+    """Options for how the reader and writer stages run."""
+    return _options(
+        click.option('--transport', type=click.Choice([QUEUE, SHM]),
+                     default=QUEUE, required=False, show_default=True,
+                     help=("How data move between the reader and writer "
+                           "processes, through a queue or a shared memory "
+                           "ring")),
+        click.option('--max-buffer-mb', type=click.IntRange(min=1),
+                     default=MAX_BUFFER_MB, required=False,
+                     show_default=True,
+                     help=("Most data in megabytes to buffer between the "
+                           "reader and writer processes")),
+        click.option('--engine', type=click.Choice([PROCESSES, THREADS]),
+                     default=PROCESSES, required=False, show_default=True,
+                     help=("Whether to read and write in separate processes, "
+                           "or in threads of one process")),
+        click.option('--start-method', type=click.Choice(start_methods),
+                     default=SPAWN, required=False, show_default=True,
+                     help="How processes are started with --engine processes"))
+
+
+def _pipe_size_option(pipes, pronoun):
+    """Option for the capacity to request of the pipes described."""
+    return click.option(
+        '--pipe-size-mb', type=click.IntRange(min=0), default=PIPE_SIZE_MB,
+        required=False, show_default=True,
+        help=(f"Capacity in megabytes to request of {pipes}, 0 to leave "
+              f"{pronoun} unchanged"))
+
+
 @cli.command()
-@click.option('--file-map', type=click.Path(exists=True), required=True,
-              help="Files with record counts for processing")
-@click.option('--batch', type=int, required=True,
-              help="0-based index for batch offset")
-@click.option('--batch-size', type=int, required=True,
-              help="Number of records per batch")
+@_batch_options
 @click.option('--output', type=click.Path(exists=False), required=False,
-              default='-', help="Where to write, '-' for stdout")
+              default='-',
+              help=("Where to write, '-' for stdout. A file is compressed "
+                    "according to its extension"))
 @click.option('--paired-handling',
               type=click.Choice([INTERLEAVE, R1ONLY, R2ONLY, SEQUENTIAL]),
               default=SEQUENTIAL, required=False,
               help="How to handle paired data")
-def mux(file_map, batch, batch_size, output, paired_handling):
+@_reader_options
+@click.option('--compression-threads', type=click.IntRange(min=1),
+              default=1, required=False, show_default=True,
+              help="Number of threads to compress a file --output with")
+@click.option('--compression-level', type=int, default=None,
+              required=False,
+              help="Compression level of a file --output, by default per codec")
+@_stage_options()
+@_pipe_size_option("a stdout pipe", "it")
+@click.option('--direct-write/--buffered-write', default=True,
+              show_default=True,
+              help=("Whether to write to stdout directly with writev, or "
+                    "through a buffered writer"))
+def mux(file_map, batch, batches, batch_size, output, paired_handling,
+        gzip_backend, prefetch, compression_threads, compression_level,
+        transport, max_buffer_mb, engine, start_method, pipe_size_mb,
+        direct_write, readers, reader_order):
     """Multiplex a set of files into a single stream."""
+    batch = _resolve_batches(batch, batches)
     file_map = FileMap.from_tsv(file_map, batch_size)
 
-    if batch == 0:
+    if 0 in batch:
         file_map.check_paths()
 
-    mxfile_batch = file_map.batch(batch)
+    mxfile_batch = file_map.batches(batch)
     if not mxfile_batch:
         click.echo("Nothing to do...", err=True)
         sys.exit(0)
 
-    mx = Multiplex(file_map, batch, paired_handling, output)
-    mx.start()
+    mx = Multiplex(file_map, batch, paired_handling, output, gzip_backend,
+                   prefetch, compression_threads, compression_level,
+                   transport, max_buffer_mb, engine, start_method,
+                   pipe_size_mb, direct_write, readers, reader_order)
+    if not mx.start():
+        sys.exit(1)
 
 
 @cli.command()
 @click.option('--mux-input', type=str, required=False,
               default='-', help="The multiplexed data, '-' for stdin")
-@click.option('--file-map', type=click.Path(exists=True), required=True,
-              help="Files with record counts for processing")
-@click.option('--batch', type=int, required=True,
-              help="0-based index for batch offset")
-@click.option('--batch-size', type=int, required=True,
-              help="Number of records per batch")
+@_batch_options
 @click.option('--output-base', type=click.Path(exists=False), required=True,
               help="Where to write")
 @click.option('--paired-handling',
@@ -61,12 +176,20 @@ def mux(file_map, batch, batch_size, output, paired_handling):
 @click.option('--extension', type=str, required=True,
               help=("The output file extension to use, which determines "
                     "what compression to use"))
-def demux(mux_input, file_map, batch, batch_size, output_base,
-          paired_handling, extension):
+@_compression_options
+@_partial_compression_level_option
+@_stage_options()
+@_pipe_size_option("a stdin pipe", "it")
+def demux(mux_input, file_map, batch, batches, batch_size, output_base,
+          paired_handling, extension, compression_threads, bgzf,
+          compression_level, partial_extension, partial_compression_level,
+          zstd_dict, transport, max_buffer_mb, engine, start_method,
+          pipe_size_mb):
     """Demultiplex a stream into a set of files."""
+    batch = _resolve_batches(batch, batches)
     file_map = FileMap.from_tsv(file_map, batch_size)
 
-    mxfile_batch = file_map.batch(batch)
+    mxfile_batch = file_map.batches(batch)
     if not mxfile_batch:
         click.echo("Nothing to do...", err=True)
         sys.exit(0)
@@ -74,8 +197,92 @@ def demux(mux_input, file_map, batch, batch_size, output_base,
     pathlib.Path(output_base).mkdir(parents=True, exist_ok=True)
 
     dx = Demultiplex(file_map, batch, paired_handling, mux_input, output_base,
-                     extension)
-    dx.start()
+                     extension, compression_threads, bgzf,
+                     partial_extension, compression_level,
+                     partial_compression_level, _read_zstd_dict(zstd_dict),
+                     transport, max_buffer_mb, engine, start_method,
+                     pipe_size_mb)
+    if not dx.start():
+        sys.exit(1)
+
+
+@cli.command(context_settings={'ignore_unknown_options': True})
+@_batch_options
+@click.option('--output-base', type=click.Path(exists=False), required=True,
+              help="Where to write")
+@click.option('--extension', type=str, required=True,
+              help=("The output file extension to use, which determines "
+                    "what compression to use"))
+@click.option('--mux-paired-handling',
+              type=click.Choice([INTERLEAVE, R1ONLY, R2ONLY, SEQUENTIAL]),
+              default=SEQUENTIAL, required=False, show_default=True,
+              help="How to handle paired data going into the tool")
+@click.option('--demux-paired-handling',
+              type=click.Choice([SEPARATE, MERGE]),
+              default=SEPARATE, required=False, show_default=True,
+              help="How to handle paired data coming out of the tool")
+@_reader_options
+@_compression_options
+@_partial_compression_level_option
+@_stage_options((SPAWN, FORKSERVER))
+@_pipe_size_option("the tool's stdin and stdout pipes", "them")
+@click.option('--shards', type=click.IntRange(min=1), default=1,
+              required=False, show_default=True,
+              help="Number of copies of the tool to distribute records over")
+@click.option('--distribution', type=click.Choice([ROUND_ROBIN, LOAD]),
+              default=ROUND_ROBIN, required=False, show_default=True,
+              help=("Whether to deal chunks of records to shards in turn, or "
+                    "to the shard with the least input waiting"))
+@click.option('--metrics', type=click.Path(exists=False), default=None,
+              required=False,
+              help="Where to write the metrics of each stage as JSON")
+@click.argument('command', nargs=-1, required=True, type=click.UNPROCESSED)
+def run(file_map, batch, batches, batch_size, output_base, extension,
+        mux_paired_handling, demux_paired_handling, gzip_backend, prefetch,
+        readers, reader_order, compression_threads, bgzf, compression_level,
+        partial_extension, partial_compression_level, zstd_dict, transport,
+        max_buffer_mb, engine, start_method, pipe_size_mb, shards,
+        distribution, metrics, command):
+    """Multiplex a batch through a tool, and demultiplex its output.
+
+    The tool and its arguments follow a --, e.g.
+
+    mxdx run ... -- bowtie2 -p 8 -x db -q - --no-head --no-unal
+    """
+    batch = _resolve_batches(batch, batches)
+    file_map = FileMap.from_tsv(file_map, batch_size)
+
+    if 0 in batch:
+        file_map.check_paths()
+
+    mxfile_batch = file_map.batches(batch)
+    if not mxfile_batch:
+        click.echo("Nothing to do...", err=True)
+        sys.exit(0)
+
+    pathlib.Path(output_base).mkdir(parents=True, exist_ok=True)
+
+    mux_options = {'gzip_backend': gzip_backend, 'prefetch': prefetch,
+                   'readers': readers, 'reader_order': reader_order}
+    demux_options = {'compression_threads': compression_threads,
+                     'bgzf': bgzf, 'compression_level': compression_level,
+                     'partial_extension': partial_extension,
+                     'partial_compression_level': partial_compression_level,
+                     'zstd_dict': _read_zstd_dict(zstd_dict)}
+    rx = Run(file_map, batch, command, output_base, extension,
+             mux_paired_handling, demux_paired_handling, transport,
+             max_buffer_mb, engine, start_method, pipe_size_mb, shards,
+             distribution, mux_options, demux_options)
+
+    try:
+        rx.start()
+    except RuntimeError as e:
+        click.echo(str(e), err=True)
+        sys.exit(1)
+    finally:
+        if metrics is not None and rx.metrics is not None:
+            with open(metrics, 'w') as fp:
+                json.dump(rx.metrics, fp, indent=2)
 
 
 @cli.command()
@@ -84,10 +291,100 @@ def demux(mux_input, file_map, batch, batch_size, output_base,
 @click.option('--extension', type=str, required=True,
               help=("The output file extension to use, which determines "
                     "what compression to use"))
-def consolidate_partials(output_base, extension):
+@_gzip_backend_option
+@_compression_options
+@_stage_options()
+def consolidate_partials(output_base, extension, gzip_backend,
+                         compression_threads, bgzf, compression_level,
+                         partial_extension, zstd_dict, transport,
+                         max_buffer_mb, engine, start_method):
     """Consolidate partial files."""
-    cx = Consolidate(output_base, extension)
-    cx.start()
+    cx = Consolidate(output_base, extension, gzip_backend,
+                     compression_threads, bgzf, partial_extension,
+                     compression_level, _read_zstd_dict(zstd_dict),
+                     transport, max_buffer_mb, engine, start_method)
+    if not cx.start():
+        sys.exit(1)
+
+
+@cli.command('train-zstd-dict')
+@click.option('--mux-input', type=str, required=False,
+              default='-', help="The multiplexed data, '-' for stdin")
+@click.option('--output', type=click.Path(exists=False), required=True,
+              help="Where to write the dictionary")
+@click.option('--max-records', type=click.IntRange(min=1), default=100000,
+              required=False, show_default=True,
+              help="Number of records to sample from the start of the stream")
+@click.option('--dict-size', type=click.IntRange(min=1),
+              default=ZSTD_DICT_SIZE, required=False, show_default=True,
+              help="Maximum size of the dictionary in bytes")
+def train_dict(mux_input, output, max_records, dict_size):
+    """Train a zstd dictionary from a stream as demux would receive it."""
+    if mux_input == '-':
+        mux_input = sys.stdin
+    else:
+        mux_input = open(mux_input, 'rt')
+
+    try:
+        mux_input, read_f, _ = IO.io_from_stream(mux_input)
+    except StopIteration:
+        click.echo("Nothing to do...", err=True)
+        sys.exit(0)
+
+    samples = []
+    for rec in itertools.islice(read_f(mux_input), max_records):
+        # outputs are not tagged, so neither should the samples be
+        _, sep, untagged = rec.id.partition('_')
+        if not sep:
+            raise click.ClickException(
+                f"Record '{rec.id}' is not tagged. Expected the output of "
+                "mux, or of the tool run on it")
+        rec.id = untagged
+        samples.append(rec.write().encode('utf-8'))
+
+    pathlib.Path(output).write_bytes(train_zstd_dict(samples, dict_size))
+
+
+def _resolve_batches(batch, batches):
+    """Resolve --batch or --batches to a range of batch numbers."""
+    if (batch is None) == (batches is None):
+        raise click.UsageError("Specify one of --batch or --batches")
+
+    if batches is None:
+        return range(batch, batch + 1)
+
+    start, sep, stop = batches.partition('-')
+    try:
+        start = int(start)
+        stop = int(stop) if sep else start
+    except ValueError:
+        raise click.BadParameter(f"Expected a range such as 10-19, found "
+                                 f"'{batches}'", param_hint='--batches')
+
+    if start < 0 or stop < start:
+        raise click.BadParameter(f"Invalid range '{batches}'",
+                                 param_hint='--batches')
+    return range(start, stop + 1)
+
+
+def _read_zstd_dict(path):
+    if path is None:
+        return None
+    return pathlib.Path(path).read_bytes()
+
+
+@cli.command()
+@click.option('--file-map', type=click.Path(exists=True), required=True,
+              help="Files with record counts for processing")
+@click.option('--output', type=click.Path(exists=False), required=True,
+              help="Where to write the annotated file map")
+def annotate_file_map(file_map, output):
+    """Record the format and compression of each file in a file map."""
+    # batch size does not matter here, but is required for the map
+    file_map = FileMap.from_tsv(file_map, 1)
+    file_map.check_paths()
+    file_map.annotate()
+    file_map.to_tsv(output)
 
 
 @cli.command()
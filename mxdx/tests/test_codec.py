@@ -0,0 +1,286 @@
+import unittest
+import os
+import io
+import bz2
+import gzip
+import lzma
+import shutil
+import pickle
+import struct
+import tempfile
+import zlib
+from importlib.util import find_spec
+from unittest import mock
+
+from mxdx._io import IO
+from mxdx._codec import (GZIP_BACKENDS, GZIP_BACKEND_ENV, AUTO,
+                         available_gzip_backends, resolve_gzip_backend,
+                         open_gzip, _PipedDecompressor, ReadAhead,
+                         OutputCodec, compression_from_extension,
+                         BGZF_EOF, BGZF_BLOCKSIZE, train_zstd_dict)
+
+
+class GzipBackendTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = f"{self.tmpdir}/data.gz"
+        self.exp = b''.join([b">%d\nATGC\n" % i for i in range(1000)])
+        with gzip.open(self.path, 'wb') as fp:
+            fp.write(self.exp)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_available_gzip_backends(self):
+        obs = available_gzip_backends()
+        self.assertIn('python', obs)
+        self.assertEqual(obs, [b for b in GZIP_BACKENDS if b in obs])
+
+    def test_resolve_gzip_backend(self):
+        self.assertEqual(resolve_gzip_backend('python'), 'python')
+
+        with mock.patch('mxdx._codec.available_cores', return_value=8):
+            self.assertEqual(resolve_gzip_backend(AUTO),
+                             available_gzip_backends()[0])
+
+        # parallel backends are not worthwhile on a single core
+        with mock.patch('mxdx._codec.available_cores', return_value=1):
+            obs = resolve_gzip_backend(AUTO)
+            self.assertFalse(GZIP_BACKENDS[obs].parallel)
+
+        with self.assertRaises(ValueError):
+            resolve_gzip_backend('foo')
+
+    def test_resolve_gzip_backend_env(self):
+        with mock.patch.dict(os.environ, {GZIP_BACKEND_ENV: 'python'}):
+            self.assertEqual(resolve_gzip_backend(), 'python')
+
+        with mock.patch.dict(os.environ, {GZIP_BACKEND_ENV: 'foo'}):
+            with self.assertRaises(ValueError):
+                resolve_gzip_backend()
+
+    def test_open_gzip(self):
+        for backend in available_gzip_backends():
+            with open(self.path, 'rb') as raw:
+                # simulate having sniffed the magic bytes
+                raw.peek(8)
+                obs = open_gzip(raw, backend).read()
+            self.assertEqual(obs, self.exp, msg=backend)
+
+    @unittest.skipIf(shutil.which('gzip') is None, "gzip is not available")
+    def test_piped_decompressor(self):
+        with open(self.path, 'rb') as raw:
+            raw.peek(8)
+            piped = io.BufferedReader(_PipedDecompressor(['gzip', '-dc'],
+                                                         raw))
+            self.assertEqual(piped.read(), self.exp)
+            piped.close()
+
+    @unittest.skipIf(shutil.which('gzip') is None, "gzip is not available")
+    def test_piped_decompressor_early_close(self):
+        with open(self.path, 'rb') as raw:
+            piped = io.BufferedReader(_PipedDecompressor(['gzip', '-dc'],
+                                                         raw))
+            self.assertEqual(piped.read(4), self.exp[:4])
+            piped.close()
+            self.assertTrue(piped.closed)
+
+
+class ReadAheadTests(unittest.TestCase):
+    def test_read(self):
+        exp = b''.join([b">%d\nATGC\n" % i for i in range(1000)])
+        stream = io.BufferedReader(ReadAhead(io.BytesIO(exp)))
+        self.assertEqual(stream.read(), exp)
+        stream.close()
+
+    def test_small_blocks(self):
+        exp = b''.join([b">%d\nATGC\n" % i for i in range(1000)])
+        with mock.patch.object(ReadAhead, 'BLOCKSIZE', 7):
+            stream = io.TextIOWrapper(io.BufferedReader(
+                ReadAhead(io.BytesIO(exp))))
+            self.assertEqual(stream.readlines(),
+                             exp.decode('ascii').splitlines(keepends=True))
+            stream.close()
+
+    def test_early_close(self):
+        data = io.BytesIO(b'x' * (ReadAhead.BLOCKSIZE * 20))
+        stream = ReadAhead(data)
+        self.assertEqual(stream.read(4), b'xxxx')
+        stream.close()
+        self.assertTrue(data.closed)
+
+    def test_error(self):
+        class Broken(io.RawIOBase):
+            def readable(self):
+                return True
+
+            def readinto(self, b):
+                raise IOError("broken")
+
+        stream = ReadAhead(Broken())
+        with self.assertRaisesRegex(IOError, "broken"):
+            stream.read(4)
+        stream.close()
+
+
+class OutputCodecTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.exp = ''.join([f">{i}\nATGC\n" for i in range(10000)])
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_compression_from_extension(self):
+        self.assertEqual(compression_from_extension('fna.gz'), 'gzip')
+        self.assertEqual(compression_from_extension('.sam.xz'), 'xz')
+        self.assertEqual(compression_from_extension('fq.bz2'), 'bzip2')
+        self.assertEqual(compression_from_extension('fq.lz4'), 'lz4')
+        self.assertEqual(compression_from_extension('fq.zst'), 'zstd')
+        self.assertEqual(compression_from_extension('fna'), None)
+
+    def test_open(self):
+        readers = {'gz': gzip.open, 'xz': lzma.open, 'bz2': bz2.open,
+                   'fna': open}
+        for ext, reader in readers.items():
+            for threads in (1, 3):
+                codec = OutputCodec(f"fna.{ext}", threads)
+                path = f"{self.tmpdir}/{threads}.{ext}"
+
+                # use small blocks so we observe many of them
+                with mock.patch.object(OutputCodec, 'BLOCKSIZE', 1000):
+                    with codec.open(path, 'wt') as fp:
+                        fp.write(self.exp)
+                codec.close()
+
+                with reader(path, 'rt') as fp:
+                    self.assertEqual(fp.read(), self.exp,
+                                     msg=(ext, threads))
+
+    @unittest.skipIf(find_spec('lz4') is None, "lz4 is not available")
+    def test_open_lz4(self):
+        for threads in (1, 3):
+            codec = OutputCodec("fna.lz4", threads)
+            path = f"{self.tmpdir}/{threads}.lz4"
+            with mock.patch.object(OutputCodec, 'BLOCKSIZE', 1000):
+                with codec.open(path, 'wt') as fp:
+                    fp.write(self.exp)
+            codec.close()
+
+            with open(path, 'rb') as raw:
+                self.assertEqual(IO.compression_from_magic(raw.peek(8)),
+                                 'lz4')
+                with IO.decompressed(raw) as fp:
+                    self.assertEqual(fp.read().decode('ascii'), self.exp)
+
+    @unittest.skipIf(find_spec('zstandard') is None,
+                     "zstandard is not available")
+    def test_open_zstd(self):
+        for threads in (1, 3):
+            codec = OutputCodec("fna.zst", threads)
+            path = f"{self.tmpdir}/{threads}.zst"
+            with codec.open(path, 'wt') as fp:
+                fp.write(self.exp)
+            codec.close()
+
+            with open(path, 'rb') as raw:
+                self.assertEqual(IO.compression_from_magic(raw.peek(8)),
+                                 'zstd')
+                with IO.decompressed(raw) as fp:
+                    self.assertEqual(fp.read().decode('ascii'), self.exp)
+
+    @unittest.skipIf(find_spec('zstandard') is None,
+                     "zstandard is not available")
+    def test_open_zstd_dict(self):
+        import zstandard
+
+        samples = [f">{i}\nATGC\n".encode('ascii') for i in range(10000)]
+        zstd_dict = train_zstd_dict(samples, 4096)
+        self.assertTrue(0 < len(zstd_dict) <= 4096)
+
+        codec = OutputCodec("fna.zst", 2, zstd_dict=zstd_dict)
+
+        # the digested dictionary does not travel with the codec
+        codec = pickle.loads(pickle.dumps(codec))
+
+        paths = [f"{self.tmpdir}/{i}.zst" for i in range(3)]
+        for path in paths:
+            with codec.open(path, 'wt') as fp:
+                fp.write(self.exp)
+        codec.close()
+
+        for path in paths:
+            with open(path, 'rb') as raw:
+                with IO.decompressed(raw, zstd_dict=zstd_dict) as fp:
+                    self.assertEqual(fp.read().decode('ascii'), self.exp)
+
+            # and the dictionary is required to decompress
+            with open(path, 'rb') as raw:
+                with self.assertRaises(zstandard.ZstdError):
+                    IO.decompressed(raw).read()
+
+    def test_open_empty(self):
+        codec = OutputCodec("fna.gz", 2)
+        path = f"{self.tmpdir}/empty.gz"
+        codec.open(path, 'wb').close()
+        codec.close()
+
+        with gzip.open(path, 'rb') as fp:
+            self.assertEqual(fp.read(), b'')
+        self.assertTrue(os.path.getsize(path) > 0)
+
+    def test_open_bgzf(self):
+        for threads in (1, 3):
+            codec = OutputCodec("fna.gz", threads, bgzf=True)
+            path = f"{self.tmpdir}/{threads}.gz"
+            with codec.open(path, 'wt') as fp:
+                fp.write(self.exp)
+            codec.close()
+
+            with gzip.open(path, 'rt') as fp:
+                self.assertEqual(fp.read(), self.exp)
+
+            with open(path, 'rb') as fp:
+                compressed = fp.read()
+            self.assertTrue(compressed.endswith(BGZF_EOF))
+
+            with open(f"{path}.gzi", 'rb') as fp:
+                index = fp.read()
+            n_entries, = struct.unpack('<Q', index[:8])
+            exp_entries = len(self.exp) // BGZF_BLOCKSIZE
+            self.assertEqual(n_entries, exp_entries)
+
+            # every indexed block is independently decompressable
+            exp = self.exp.encode('ascii')
+            for i in range(n_entries):
+                c_off, u_off = struct.unpack('<2Q',
+                                             index[8 + 16 * i:24 + 16 * i])
+                bsize, = struct.unpack('<H', compressed[c_off + 16:
+                                                        c_off + 18])
+                block = compressed[c_off:c_off + bsize + 1]
+                obs = zlib.decompress(block, 16 + zlib.MAX_WBITS)
+                self.assertEqual(obs, exp[u_off:u_off + len(obs)])
+
+    def test_open_bgzf_empty(self):
+        codec = OutputCodec("fna.gz", bgzf=True)
+        path = f"{self.tmpdir}/empty.gz"
+        codec.open(path, 'wb').close()
+
+        with open(path, 'rb') as fp:
+            self.assertEqual(fp.read(), BGZF_EOF)
+        with open(f"{path}.gzi", 'rb') as fp:
+            self.assertEqual(fp.read(), struct.pack('<Q', 0))
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            OutputCodec("fna.gz", 0)
+
+        with self.assertRaises(ValueError):
+            OutputCodec("fna.xz", bgzf=True)
+
+        with self.assertRaises(ValueError):
+            OutputCodec("fna.gz", 2).open(f"{self.tmpdir}/foo", 'rt')
+
+
+if __name__ == '__main__':
+    unittest.main()
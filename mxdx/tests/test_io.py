@@ -1,6 +1,9 @@
 import unittest
 import io
 import os
+import gzip
+import shutil
+import tempfile
 
 from mxdx._io import (FileMap, MuxFile, IO, ParseError, FastaRecord,
                       FastqRecord, SamRecord)
@@ -92,6 +95,17 @@ class FileMapTests(unittest.TestCase):
                           MuxFile("bing", None, 0, 10, '4.738.2', True), ))
         self.assertEqual(obs.batch(3), tuple())
 
+    def test_filemap_batches(self):
+        obs = FileMap.from_tsv(self.fm_unpaired, 500)
+        self.assertEqual(obs.batches(range(1, 3)),
+                         (MuxFile("baz", None, 200, 700, '3.73f.1', False),
+                          MuxFile("baz", None, 700, 1000, '3.73f.2', False),
+                          MuxFile("bing", None, 0, 10, '4.738.2', True)))
+
+        # batches beyond the last are empty
+        self.assertEqual(obs.batches(range(2, 5)), obs.batch(2))
+        self.assertEqual(obs.batches(range(3, 5)), tuple())
+
     def test_parse_file_map_paired(self):
         obs = FileMap.from_tsv(self.fm_paired, 1)
         # we intentionally manipulate the private batch size variable
@@ -128,6 +142,54 @@ class FileMapTests(unittest.TestCase):
                           MuxFile("bing", "bing2", 0, 10, '4.738.2', True), ))
         self.assertEqual(obs.batch(3), tuple())
 
+    def test_filemap_unexpected_header(self):
+        fm = _serialize([["filename_1", "record_count", "foo"],
+                         ["foo", "100", "bar"]])
+        with self.assertRaises(ValueError):
+            FileMap.from_tsv(fm, 1)
+
+        fm = _serialize([["filename_1", "record_count", "compression_2"],
+                         ["foo", "100", "gzip"]])
+        with self.assertRaises(ValueError):
+            FileMap.from_tsv(fm, 1)
+
+        fm = _serialize([["filename_1", "record_count", "format"],
+                         ["foo", "100", "bam"]])
+        with self.assertRaises(ValueError):
+            FileMap.from_tsv(fm, 1)
+
+    def test_filemap_annotated(self):
+        fm = _serialize([["filename_1", "record_count", "format",
+                          "compression_1"],
+                         ["foo", "100", "fastq", "gzip"],
+                         ["bar", "200", "sam", "none"]])
+        obs = FileMap.from_tsv(fm, 150)
+        self.assertEqual(obs.batch(0),
+                         (MuxFile("foo", None, 0, 100, '1.acb.0', True,
+                                  'fastq', 'gzip', None),
+                          MuxFile("bar", None, 0, 50, '2.37b.0', False,
+                                  'sam', 'none', None)))
+
+    def test_filemap_annotate(self):
+        cwd = os.path.dirname(__file__)
+        fm = _serialize([["filename_1", "filename_2", "record_count"],
+                         [f"{cwd}/test_data/foo_r1.fasta",
+                          f"{cwd}/test_data/foo_r2.fasta", "12"]])
+        obs = FileMap.from_tsv(fm, 100)
+        obs.annotate()
+        self.assertEqual(obs.batch(0)[0][6:],
+                         ('fasta-strict', 'none', 'none'))
+
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        obs.to_tsv(f"{tmpdir}/map.tsv")
+
+        # the file map should round trip and retain its annotations
+        obs = FileMap.from_tsv(f"{tmpdir}/map.tsv", 100)
+        self.assertTrue(obs.is_paired)
+        self.assertEqual(obs.batch(0)[0][6:],
+                         ('fasta-strict', 'none', 'none'))
+
     def test_filemap_check_paths(self):
         exp = ("foo", "bar", "baz", "bing")
         obs = FileMap.from_tsv(self.fm_unpaired, 1).check_paths(raises=False)
@@ -209,7 +271,7 @@ class IOTests(unittest.TestCase):
         stream = io.StringIO(data)
         sniffed, r_f, w_f = IO.io_from_stream(stream, n_lines=4)
         self.assertEqual(sniffed.read(), data)
-        self.assertEqual(r_f, IO.read_fasta)
+        self.assertEqual(r_f, IO.read_fasta_strict)
         self.assertEqual(w_f, IO.write_fasta)
 
     def test_io_from_mx(self):
@@ -217,10 +279,39 @@ class IOTests(unittest.TestCase):
         mx = MuxFile(f"{cwd}/test_data/foo_r1.fasta", None, 0, 12, 'blah',
                      True)
         o_f, r_f, w_f = IO.io_from_mx(mx)
-        self.assertEqual(o_f, open)
-        self.assertEqual(r_f, IO.read_fasta)
+        self.assertEqual(o_f, IO.open_input)
+        self.assertEqual(r_f, IO.read_fasta_strict)
         self.assertEqual(w_f, IO.write_fasta)
 
+    def test_io_from_mx_known_format(self):
+        # the file does not exist, so the format must come from the mxfile
+        mx = MuxFile("does-not-exist", None, 0, 12, 'blah', True,
+                     'fastq-strict', 'gzip', None)
+        o_f, r_f, w_f = IO.io_from_mx(mx)
+        self.assertEqual(o_f, IO.open_input)
+        self.assertEqual(r_f, IO.read_fastq_strict)
+        self.assertEqual(w_f, IO.write_fastq)
+
+    def test_open_input_magic(self):
+        cwd = os.path.dirname(__file__)
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+
+        with open(f"{cwd}/test_data/foo_r1.fasta", 'rb') as fp:
+            exp = fp.read()
+
+        # gzip data with a misleading extension
+        path = f"{tmpdir}/mislabeled.fasta"
+        with gzip.open(path, 'wb') as fp:
+            fp.write(exp)
+
+        with IO.open_input(path) as fp:
+            self.assertEqual(fp.read(), exp.decode('ascii'))
+
+        self.assertEqual(IO.sniff_file(path), ('fasta-strict', 'gzip'))
+        self.assertEqual(IO.sniff_file(f"{cwd}/test_data/foo_r1.fasta"),
+                         ('fasta-strict', 'none'))
+
     def test_read(self):
         data = '\n'.join([">1", "aatt", ">2", "aa", ">3", "tt", ">4", "gg",
                           ">5", "cc", ">6", "gc", ""])
@@ -236,9 +327,53 @@ class IOTests(unittest.TestCase):
         with self.assertRaises(ParseError):
             list(IO.read(IO.read_fasta, data, 2, 10, None))
 
+    def _write_tmp(self, data, name='data'):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = f"{tmpdir}/{name}"
+        with open(path, 'w') as fp:
+            fp.write(data)
+        return path
+
+    def test_read_file_mapped(self):
+        data = '\n'.join(["@a", "at", "+", "##", "@b", "gc", "+", "@@",
+                          "@c", "tt", "+", "#@", ""])
+        path = self._write_tmp(data)
+        exp = list(IO.read(IO.read_fastq_strict, io.StringIO(data), 1, 3,
+                           None))
+        obs = list(IO.read_file(IO.read_fastq_strict, path, None, 1, 3,
+                                None))
+        self.assertEqual(obs, exp)
+        self.assertEqual(obs, [FastqRecord('b', 'gc\n+\n@@\n'),
+                               FastqRecord('c', 'tt\n+\n#@\n')])
+
+        with self.assertRaises(ParseError):
+            list(IO.read_file(IO.read_fastq_strict, path, None, 1, 4, None))
+
+    def test_read_file_mapped_fallback(self):
+        # the second record wraps, so the general parser must take over
+        data = '\n'.join([">a", "at", ">b", "gc", "cc", ">c", "tt", ""])
+        path = self._write_tmp(data)
+        obs = list(IO.read_file(IO.read_fasta_strict, path, None, 1, 3,
+                                None))
+        self.assertEqual(obs, [FastaRecord('b', 'gccc\n'),
+                               FastaRecord('c', 'tt\n')])
+
+    def test_read_file_mapped_sam(self):
+        path = self._write_tmp(example_sam)
+        exp = list(IO.read_sam(io.StringIO(example_sam)))[1:]
+        obs = list(IO.read_file(IO.read_sam, path, None, 1, 3, None))
+        self.assertEqual(obs, exp)
+
     def test_sniff(self):
         tests = [(">foo bar\nATGC\nTTT\n>bar\nTTTT\n", IO.read_fasta),
-                 ("@foo\nATGC\n+\n####\n@bar\nTTTT\n+\n####\n", IO.read_fastq),
+                 ("@foo\nATGC\n+\n####\n@bar\nTTTT\n+\n####\n",
+                  IO.read_fastq_strict),
+                 ("@foo\nATGC\n+\n####\n@bar\nTT\nTT\n+\n####\n",
+                  IO.read_fastq),
+                 (">foo\nATGC\n>bar\nTTTT\n", IO.read_fasta_strict),
+                 # a truncated trailing line is ignored
+                 (">foo\nATGC\n>bar\nTTTT\n>ba", IO.read_fasta_strict),
                  (("HWI-ST208:453:C1T26ACXX:2:1108:8119:36567/1\t16\t"
                    "G010669145\t5212917\t"), IO.read_sam)]
 
@@ -269,6 +404,42 @@ class IOTests(unittest.TestCase):
         obs = list(IO.read_fastq(io.StringIO(data)))
         self.assertEqual(obs, exp)
 
+    def test_read_fasta_strict(self):
+        data = '\n'.join([">foo bar", "atgc", ">baz", "gg", ""])
+        exp = [FastaRecord('foo', 'atgc\n'),
+               FastaRecord('baz', 'gg\n')]
+        obs = list(IO.read_fasta_strict(io.StringIO(data)))
+        self.assertEqual(obs, exp)
+
+    def test_read_fasta_strict_fallback(self):
+        # the second record is wrapped, which strict parsing cannot handle
+        data = '\n'.join([">foo bar", "atgc", ">baz", "gg", "tt", ">bing",
+                          "cc", ""])
+        exp = [FastaRecord('foo', 'atgc\n'),
+               FastaRecord('baz', 'ggtt\n'),
+               FastaRecord('bing', 'cc\n')]
+        obs = list(IO.read_fasta_strict(io.StringIO(data)))
+        self.assertEqual(obs, exp)
+
+    def test_read_fastq_strict(self):
+        data = '\n'.join(["@foo bar", "atgc", "+", "####",
+                          "@baz", "ttgg", "+", "@@@@", ""])
+        exp = [FastqRecord('foo', 'atgc\n+\n####\n'),
+               FastqRecord('baz', 'ttgg\n+\n@@@@\n')]
+        obs = list(IO.read_fastq_strict(io.StringIO(data)))
+        self.assertEqual(obs, exp)
+
+    def test_read_fastq_strict_fallback(self):
+        # the second record has a wrapped quality
+        data = '\n'.join(["@foo bar", "atgc", "+", "####",
+                          "@baz", "ttgg", "+", "@@", "@@",
+                          "@bing", "aa", "+", "##", ""])
+        exp = [FastqRecord('foo', 'atgc\n+\n####\n'),
+               FastqRecord('baz', 'ttgg\n+\n@@@@\n'),
+               FastqRecord('bing', 'aa\n+\n##\n')]
+        obs = list(IO.read_fastq_strict(io.StringIO(data)))
+        self.assertEqual(obs, exp)
+
     def test_read_sam(self):
         exp = [SamRecord("HWI-ST208:453:C1T26ACXX:2:1108:8119:36567/1",
                       "16	G010669145	5212917	35	51M	*	0	0	CGATCGATCTCCTCGACCTCCTGACTCTACTGCCAGAAGAATAGATAAGGA	EHIJIHGIJJIGGIGEHGIGIHFHJGJJHJIGDJJJIJGHHHHFFFFD@@B	AS:i:0	XS:i:-1	XN:i:0	XM:i:0	XO:i:0	XG:i:0	NM:i:0	MD:Z:51	YT:Z:UU\n"),  # noqa
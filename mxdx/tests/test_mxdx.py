@@ -1,16 +1,29 @@
 import unittest
 import io
 import os
+import sys
+import subprocess
 import shutil
 import hashlib
 import multiprocessing as mp
+from multiprocessing.connection import wait
 import tempfile
+import threading
+import pickle
 import gzip
+import lzma
 
-from mxdx._mxdx import Multiplex, Demultiplex, Consolidate
+from unittest import mock
+from importlib.util import find_spec
+
+from mxdx._mxdx import (Multiplex, Demultiplex, Consolidate, ChunkedQueue,
+                        QueueTransport, SharedMemoryTransport, ThreadContext)
 from mxdx._io import FileMap
 from mxdx._constants import (INTERLEAVE, SEQUENTIAL, R1ONLY, R2ONLY, MERGE,
-                             SEPARATE)
+                             SEPARATE, READ_COMPLETE, R1, R2, QUEUE, SHM,
+                             THREADS, PROCESSES, FILE_COMPLETE, ARRIVAL,
+                             ROUND_ROBIN, LOAD)
+from mxdx._pipe import PipeEnd
 
 
 def _serialize(data):
@@ -36,6 +49,15 @@ class MultiplexTests(unittest.TestCase):
         for f in self.clean_up:
             os.unlink(f)
 
+    def _mux(self, fm, paired_handling, batch=0, **kwargs):
+        # multiplex to a temporary file, and return what was written
+        tmp = tempfile.NamedTemporaryFile(delete=False)
+        tmp.close()
+        self.clean_up.append(tmp.name)
+        Multiplex(fm, batch, paired_handling, tmp.name, **kwargs).start()
+        with open(tmp.name) as data:
+            return data.read()
+
     def test_integration_sequential(self):
         foo_hash = self.foo_hash
         bar_hash = self.bar_hash
@@ -199,6 +221,268 @@ class MultiplexTests(unittest.TestCase):
 
         self.assertEqual(obs, exp)
 
+    def test_integration_prefetch(self):
+        fm = FileMap.from_tsv(self.fm_paired, 15)
+        outputs = [self._mux(fm, INTERLEAVE, prefetch=prefetch)
+                   for prefetch in (0, 1, 2, 5)]
+
+        self.assertTrue(len(outputs[0]) > 0)
+        for obs in outputs[1:]:
+            self.assertEqual(obs, outputs[0])
+
+        with self.assertRaises(ValueError):
+            Multiplex(fm, 0, INTERLEAVE, '-', prefetch=-1)
+
+    def test_integration_compressed_output(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+
+        fm = FileMap.from_tsv(self.fm_paired, 15)
+        Multiplex(fm, 0, SEQUENTIAL, f"{tmpdir}/plain").start()
+        with open(f"{tmpdir}/plain") as data:
+            exp = data.read()
+
+        mx = Multiplex(fm, 0, SEQUENTIAL, f"{tmpdir}/mux.fna.gz",
+                       compression_threads=2)
+        mx.start()
+        with gzip.open(f"{tmpdir}/mux.fna.gz", 'rt') as data:
+            self.assertEqual(data.read(), exp)
+
+        # and the staged stream can be demultiplexed directly
+        dx = Demultiplex(fm, 0, SEPARATE, f"{tmpdir}/mux.fna.gz", tmpdir,
+                         'fna')
+        dx.start()
+        with open(f"{tmpdir}/foo_r1.fasta.fna") as obs, \
+                open(f"{cwd}/test_data/foo_r1.fasta") as exp:
+            self.assertEqual(obs.read(), exp.read())
+
+    def test_integration_shm(self):
+        fm = FileMap.from_tsv(self.fm_paired, 15)
+        outputs = [self._mux(fm, INTERLEAVE, transport=transport,
+                             max_buffer_mb=1)
+                   for transport in (QUEUE, SHM)]
+
+        self.assertTrue(len(outputs[0]) > 0)
+        self.assertEqual(outputs[0], outputs[1])
+
+        with self.assertRaises(ValueError):
+            Multiplex(fm, 0, INTERLEAVE, '-', transport='carrier-pigeon')
+
+        with self.assertRaises(ValueError):
+            Multiplex(fm, 0, INTERLEAVE, '-', max_buffer_mb=0)
+
+    def test_integration_shm_stderr(self):
+        # the writer must let go of the segment before it exits, or the
+        # segment complains as it is collected
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        fm_path = f"{tmpdir}/fm.tsv"
+        with open(fm_path, 'w') as fp:
+            fp.write(self.fm_paired.read())
+
+        for readers in ('1', '2'):
+            proc = subprocess.run([sys.executable, '-m', 'mxdx.cli', 'mux',
+                                   '--file-map', fm_path, '--batch', '0',
+                                   '--batch-size', '15', '--paired-handling',
+                                   INTERLEAVE, '--transport', SHM,
+                                   '--readers', readers],
+                                  capture_output=True, text=True, check=True)
+            self.assertEqual(proc.stderr, '')
+            self.assertTrue(proc.stdout)
+
+    def test_integration_threads(self):
+        fm = FileMap.from_tsv(self.fm_paired, 15)
+        outputs = []
+        for engine, transport in ((None, QUEUE), (THREADS, QUEUE),
+                                  (THREADS, SHM)):
+            kwargs = {} if engine is None else {'engine': engine}
+            outputs.append(self._mux(fm, INTERLEAVE, transport=transport,
+                                     **kwargs))
+
+        self.assertTrue(len(outputs[0]) > 0)
+        for obs in outputs[1:]:
+            self.assertEqual(obs, outputs[0])
+
+        with self.assertRaises(ValueError):
+            Multiplex(fm, 0, INTERLEAVE, '-', engine='steam')
+
+    def test_integration_start_method(self):
+        fm = FileMap.from_tsv(self.fm_paired, 15)
+        outputs = [self._mux(fm, INTERLEAVE, start_method=start_method)
+                   for start_method in mp.get_all_start_methods()]
+
+        self.assertTrue(len(outputs[0]) > 0)
+        for obs in outputs[1:]:
+            self.assertEqual(obs, outputs[0])
+
+        with self.assertRaises(ValueError):
+            Multiplex(fm, 0, INTERLEAVE, '-', start_method='teleport')
+
+    def test_integration_batches(self):
+        fm = FileMap.from_tsv(self.fm_paired, 7)
+        outputs = []
+        for batches in ([0], [1], [2], range(0, 3)):
+            batch = batches[0] if len(batches) == 1 else batches
+            outputs.append(self._mux(fm, INTERLEAVE, batch, engine=THREADS))
+
+        # the range streams each batch in turn, under its own tags
+        self.assertEqual(outputs[-1], ''.join(outputs[:-1]))
+        self.assertIn('.2_', outputs[-1])
+
+    def test_integration_readers(self):
+        fm = FileMap.from_tsv(self.fm_paired, 15)
+        self.assertEqual(len(fm.batch(0)), 2)
+
+        def mux(**kwargs):
+            return self._mux(fm, INTERLEAVE, **kwargs)
+
+        exp = mux(engine=THREADS)
+        for engine, transport in ((PROCESSES, QUEUE), (THREADS, QUEUE),
+                                  (THREADS, SHM)):
+            obs = mux(readers=2, engine=engine, transport=transport)
+            self.assertEqual(obs, exp)
+
+            # records arrive interleaved by chunk, but are all present
+            obs = mux(readers=4, reader_order=ARRIVAL, engine=engine,
+                      transport=transport)
+            self.assertEqual(sorted(obs.splitlines()),
+                             sorted(exp.splitlines()))
+
+        with self.assertRaises(ValueError):
+            Multiplex(fm, 0, INTERLEAVE, '-', readers=0)
+        with self.assertRaises(ValueError):
+            Multiplex(fm, 0, INTERLEAVE, '-', reader_order='alphabetical')
+
+    def test_integration_stdout(self):
+        fm = FileMap.from_tsv(self.fm_paired, 15)
+        exp = self._mux(fm, INTERLEAVE, engine=THREADS)
+
+        for direct_write in (True, False):
+            with tempfile.TemporaryFile('w+') as stdout:
+                with mock.patch('sys.stdout', stdout):
+                    Multiplex(fm, 0, INTERLEAVE, '-', engine=THREADS,
+                              direct_write=direct_write).start()
+                stdout.seek(0)
+                self.assertEqual(stdout.read(), exp)
+
+        with self.assertRaises(ValueError):
+            Multiplex(fm, 0, INTERLEAVE, '-', pipe_size_mb=-1)
+
+    def test_integration_pipes(self):
+        fm = FileMap.from_tsv(self.fm_paired, 15)
+        exp = self._mux(fm, INTERLEAVE, engine=THREADS)
+
+        for distribution in (ROUND_ROBIN, LOAD):
+            pipes = [os.pipe() for _ in range(3)]
+
+            # small chunks, so each pipe is dealt some
+            with mock.patch.object(ChunkedQueue, 'CHUNKSIZE', 16), \
+                    mock.patch.object(ChunkedQueue, 'MINCHUNKSIZE', 16):
+                mx = Multiplex(fm, 0, INTERLEAVE,
+                               [PipeEnd(w) for _, w in pipes],
+                               engine=THREADS, distribution=distribution)
+                self.assertTrue(mx.start())
+
+            obs = []
+            for r, w in pipes:
+                os.close(w)
+                with open(r) as data:
+                    obs.append(data.read())
+
+            # each pipe is dealt whole pairs
+            for data in obs:
+                self.assertTrue(data)
+                self.assertEqual(len(data.splitlines()) % 4, 0)
+            self.assertEqual(sorted(''.join(obs).splitlines()),
+                             sorted(exp.splitlines()))
+
+        with self.assertRaises(ValueError):
+            Multiplex(fm, 0, INTERLEAVE, '-', distribution='random')
+
+    def test_pickle_omits_file_map(self):
+        fm = FileMap.from_tsv(self.fm_paired, 15)
+        mx = Multiplex(fm, 0, INTERLEAVE, '-')
+        obs = pickle.loads(pickle.dumps(mx))
+        self.assertIsNone(obs._file_map)
+        self.assertEqual(obs._mxfiles, mx._mxfiles)
+        self.assertIs(mx._file_map, fm)
+
+        dx = Demultiplex(fm, 0, SEPARATE, '-', 'foo', 'fna')
+        obs = pickle.loads(pickle.dumps(dx))
+        self.assertIsNone(obs._file_map)
+        self.assertEqual(obs._tag_lookup, dx._tag_lookup)
+
+    def test_reader_failure(self):
+        # the format is known, so the missing file is only found by the
+        # reader, which fails without reporting
+        rows = [["filename_1", "record_count", "format"],
+                ["/does/not/exist.fasta", "10", "fasta"]]
+        fm = FileMap.from_tsv(_serialize(rows), 15)
+
+        for engine in (PROCESSES, THREADS):
+            with self.assertRaisesRegex(RuntimeError, "failed"):
+                self._mux(fm, SEQUENTIAL, engine=engine)
+
+    def test_writer_silent(self):
+        # every stage exits cleanly, but the writer never reports completion
+        fm = FileMap.from_tsv(self.fm_paired, 15)
+        with mock.patch.object(Multiplex, '_write_complete'):
+            with self.assertRaisesRegex(RuntimeError, "failed"):
+                self._mux(fm, INTERLEAVE, engine=THREADS)
+
+    def _gzip_rows(self, tmpdir):
+        # compress the test data, but do not indicate it in the name
+        rows = [fm_paired[0]]
+        for f1, f2, count in fm_paired[1:]:
+            compressed = []
+            for f in (f1, f2):
+                path = f"{tmpdir}/{os.path.basename(f)}"
+                with open(f, 'rb') as src, gzip.open(path, 'wb') as dst:
+                    dst.write(src.read())
+                compressed.append(path)
+            rows.append(compressed + [count])
+        return rows
+
+    def test_integration_gzip(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        rows = self._gzip_rows(tmpdir)
+
+        exp = self._mux(FileMap.from_tsv(self.fm_paired, 15), SEQUENTIAL)
+
+        # the tag embeds a hash of the path, so drop it for comparison
+        def untag(data):
+            return [line.split('_', 1)[-1] for line in data.splitlines()]
+
+        fm = FileMap.from_tsv(_serialize(rows), 15)
+        for backend in ('python', 'auto'):
+            obs = self._mux(fm, SEQUENTIAL, gzip_backend=backend)
+            self.assertEqual(untag(obs), untag(exp))
+
+    @unittest.skipIf(find_spec('rapidgzip') is None,
+                     "rapidgzip is not available")
+    def test_gzip_threads(self):
+        import rapidgzip
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        fm = FileMap.from_tsv(_serialize(self._gzip_rows(tmpdir)), 15)
+
+        # the cores are shared by the readers, their prefetched files, and
+        # the mates of each
+        for handling, prefetch, readers, exp in ((SEQUENTIAL, 1, 2, 2),
+                                                 (R1ONLY, 0, 1, 16)):
+            with mock.patch('mxdx._mxdx.available_cores', return_value=16):
+                mx = Multiplex(fm, 0, handling, f"{tmpdir}/out",
+                               gzip_backend='rapidgzip', prefetch=prefetch,
+                               readers=readers, engine=THREADS)
+
+            with mock.patch('rapidgzip.RapidgzipFile',
+                            wraps=rapidgzip.RapidgzipFile) as opened:
+                self.assertTrue(mx.start())
+
+            self.assertEqual({c.kwargs['parallelization']
+                              for c in opened.call_args_list}, {exp})
+
 
 class DemultiplexTests(unittest.TestCase):
     def setUp(self):
@@ -385,6 +669,346 @@ class DemultiplexTests(unittest.TestCase):
         self.assertFalse(os.path.exists(bar2))
 
 
+    def test_demultiplex_compression_threads(self):
+        mux = '\n'.join([f">1.{self.foo_hash}.0_a/1", "ATGC",
+                         f">1.{self.foo_hash}.0_a/2", "ATGCT",
+                         f">1.{self.foo_hash}.0_b/1", "TTCC",
+                         f">1.{self.foo_hash}.0_b/2", "TTCCT", ''])
+        exp_foo1 = '\n'.join(['>a/1', 'ATGC', '>b/1', 'TTCC', ''])
+        exp_foo2 = '\n'.join(['>a/2', 'ATGCT', '>b/2', 'TTCCT', ''])
+
+        fm = FileMap.from_tsv(self.fm_paired, 15)
+        dx = Demultiplex(fm, 0, SEPARATE, io.StringIO(mux),
+                         self.clean_up.name, 'fna.xz', compression_threads=3)
+        dx.start()
+
+        base = self.clean_up.name
+        with lzma.open(f'{base}/foo_r1.fasta.fna.xz', 'rt') as fp:
+            self.assertEqual(fp.read(), exp_foo1)
+        with lzma.open(f'{base}/foo_r2.fasta.fna.xz', 'rt') as fp:
+            self.assertEqual(fp.read(), exp_foo2)
+
+    def test_demultiplex_inputs(self):
+        mux = [[f">1.{self.foo_hash}.0_a/1", "ATGC",
+                f">1.{self.foo_hash}.0_a/2", "ATGCT"],
+               [f">1.{self.foo_hash}.0_b/1", "TTCC",
+                f">1.{self.foo_hash}.0_b/2", "TTCCT"],
+               []]
+        exp_foo1 = ['>a/1', 'ATGC', '>b/1', 'TTCC']
+        exp_foo2 = ['>a/2', 'ATGCT', '>b/2', 'TTCCT']
+
+        # an empty input, e.g. a shard which found nothing, is allowed
+        fm = FileMap.from_tsv(self.fm_paired, 15)
+        for engine in (PROCESSES, THREADS):
+            mux_inputs = [io.StringIO('\n'.join(lines + [''])) if lines
+                          else io.StringIO() for lines in mux]
+            dx = Demultiplex(fm, 0, SEPARATE, mux_inputs,
+                             self.clean_up.name, 'fna', engine=engine,
+                             allow_empty=True)
+            self.assertTrue(dx.start())
+
+            # the inputs are read concurrently, so their order may vary
+            base = self.clean_up.name
+            with open(f'{base}/foo_r1.fasta.fna') as fp:
+                self.assertEqual(sorted(fp.read().splitlines()),
+                                 sorted(exp_foo1))
+            with open(f'{base}/foo_r2.fasta.fna') as fp:
+                self.assertEqual(sorted(fp.read().splitlines()),
+                                 sorted(exp_foo2))
+
+    def test_demultiplex_stdin_threads(self):
+        # a thread reading stdin must leave it open for its caller
+        fm_path = f'{self.clean_up.name}/fm.tsv'
+        with open(fm_path, 'w') as fp:
+            fp.write(_serialize(fm_paired).read())
+        mux = '\n'.join([f">1.{self.foo_hash}.0_a/1", "ATGC",
+                         f">1.{self.foo_hash}.0_a/2", "ATGCT", ''])
+        code = '\n'.join(['import gc, os, sys',
+                          'from mxdx._io import FileMap',
+                          'from mxdx._mxdx import Demultiplex',
+                          'from mxdx._constants import SEPARATE, THREADS',
+                          'fm = FileMap.from_tsv(sys.argv[1], 15)',
+                          'Demultiplex(fm, 0, SEPARATE, "-", sys.argv[2], '
+                          '"fna", engine=THREADS).start()',
+                          'gc.collect()',
+                          'os.fstat(0)'])
+        subprocess.run([sys.executable, '-c', code, fm_path,
+                        self.clean_up.name], input=mux.encode('ascii'),
+                       check=True)
+
+    def test_demultiplex_empty(self):
+        # an empty stream means upstream likely failed, unless allowed
+        fm = FileMap.from_tsv(self.fm_paired, 15)
+        for engine in (PROCESSES, THREADS):
+            dx = Demultiplex(fm, 0, SEPARATE, io.StringIO(),
+                             self.clean_up.name, 'fna', engine=engine)
+            self.assertFalse(dx.start())
+
+            dx = Demultiplex(fm, 0, SEPARATE, io.StringIO(),
+                             self.clean_up.name, 'fna', engine=engine,
+                             allow_empty=True)
+            self.assertTrue(dx.start())
+
+
+class ThreadContextTests(unittest.TestCase):
+    def test_sentinel(self):
+        # like a process, a thread's sentinel is ready once it has ended,
+        # and is released once it is joined
+        thread = ThreadContext.Process(lambda: None)
+        thread.start()
+        self.assertEqual(wait([thread.sentinel]), [thread.sentinel])
+        thread.join()
+        self.assertEqual(thread.exitcode, 0)
+        self.assertTrue(thread.sentinel.closed)
+
+
+class ChunkedQueueTests(unittest.TestCase):
+    def setUp(self):
+        self.queue = ChunkedQueue(QueueTransport(mp.get_context('spawn'),
+                                                 1024))
+
+    def _drain(self):
+        chunks = []
+        while True:
+            msg = self.queue.get()
+            if msg == READ_COMPLETE:
+                return chunks
+            chunks.append(msg)
+
+    def test_runs(self):
+        self.queue.put(">a\nAT\n", ('x', R1))
+        self.queue.put(">b\nAT\n", ('x', R1))
+        self.queue.put(">\u00e9\nAT\n", ('y', R2))
+        self.queue.put(">c\nAT\n", ('x', R1))
+        self.queue.complete()
+
+        (chunk, index), = self._drain()
+        exp = ">a\nAT\n>b\nAT\n>\u00e9\nAT\n>c\nAT\n".encode('utf-8')
+        self.assertEqual(chunk, exp)
+
+        # offsets are in bytes, not characters
+        self.assertEqual(index, ((('x', R1), 12), (('y', R2), 19),
+                                 (('x', R1), 25)))
+
+    def test_file_complete(self):
+        # a thread queue, so waiting messages are visible to get_many
+        self.queue = ChunkedQueue(QueueTransport(ThreadContext(), 1024))
+        self.queue.put(">a\nAT\n")
+        self.queue.file_complete()
+        self.queue.file_complete()
+        self.queue.complete()
+
+        # what was buffered is placed ahead of the marker
+        self.assertEqual(self.queue.get_many(10),
+                         [(b">a\nAT\n", ((None, 6), )), FILE_COMPLETE])
+        self.assertEqual(self.queue.get_many(10), [FILE_COMPLETE])
+        self.assertEqual(self.queue.get_many(10), [READ_COMPLETE])
+
+    def test_chunksize(self):
+        with mock.patch.object(ChunkedQueue, 'MINCHUNKSIZE', 10), \
+                mock.patch.object(ChunkedQueue, 'CHUNKSIZE', 10):
+            self.queue = ChunkedQueue(QueueTransport(ThreadContext(), 1024))
+            for i in range(5):
+                self.queue.put(f">{i}\nATGC\n")
+            self.queue.complete()
+
+        chunks = self._drain()
+        self.assertEqual([c for c, _ in chunks],
+                         [b">0\nATGC\n>1\nATGC\n",
+                          b">2\nATGC\n>3\nATGC\n",
+                          b">4\nATGC\n"])
+
+    def test_hold(self):
+        with mock.patch.object(ChunkedQueue, 'MINCHUNKSIZE', 10), \
+                mock.patch.object(ChunkedQueue, 'CHUNKSIZE', 10):
+            self.queue = ChunkedQueue(QueueTransport(ThreadContext(), 1024))
+
+            # a held record is placed with the one which follows it
+            for i in range(2):
+                self.queue.put(f">{i}/1\nATGC\n", R1, hold=True)
+                self.queue.put(f">{i}/2\nATGC\n", R2)
+
+            # unless the chunk grows too large
+            self.queue.put(">2/1\nATGC\n", R1, hold=True)
+            self.queue.put(">3/1\nATGC\n", R1, hold=True)
+            self.queue.complete()
+
+        chunks = self._drain()
+        self.assertEqual([c for c, _ in chunks],
+                         [b">0/1\nATGC\n>0/2\nATGC\n",
+                          b">1/1\nATGC\n>1/2\nATGC\n",
+                          b">2/1\nATGC\n>3/1\nATGC\n"])
+
+    def test_deadline(self):
+        # with no time to wait, every record is placed as it arrives
+        self.queue.DEADLINE = 0
+        for i in range(3):
+            self.queue.put(f">{i}\nATGC\n")
+        self.queue.complete()
+
+        chunks = self._drain()
+        self.assertEqual([c for c, _ in chunks],
+                         [b">0\nATGC\n", b">1\nATGC\n", b">2\nATGC\n"])
+
+    def test_flush(self):
+        self.queue = ChunkedQueue(QueueTransport(ThreadContext(), 1024))
+        self.queue.put(">0/1\nATGC\n", R1)
+        self.queue.flush()
+        self.assertEqual(self.queue.get(), (b">0/1\nATGC\n", ((R1, 10), )))
+
+        # a held record waits for the one which follows it
+        self.queue.put(">1/1\nATGC\n", R1, hold=True)
+        self.queue.flush()
+        self.queue.put(">1/2\nATGC\n", R2)
+        self.queue.flush()
+        self.assertEqual(self.queue.get(),
+                         (b">1/1\nATGC\n>1/2\nATGC\n", ((R1, 10), (R2, 20))))
+
+    def test_tune(self):
+        clock = mock.Mock(return_value=0)
+        record = ">a\n" + "A" * 46 + "\n"
+
+        def produce(n, pause):
+            for _ in range(n):
+                clock.return_value += pause
+                self.queue.put(record)
+            self.queue.file_complete()
+
+        with mock.patch.object(ChunkedQueue, 'MINCHUNKSIZE', 100), \
+                mock.patch.object(ChunkedQueue, 'CHUNKSIZE', 10000), \
+                mock.patch.object(ChunkedQueue, 'DEADLINE', 0.01), \
+                mock.patch('mxdx._mxdx.time.monotonic', clock):
+            self.queue = ChunkedQueue(QueueTransport(ThreadContext(),
+                                                     1024 * 1024))
+            produce(2000, 0)
+            produce(20, 1)
+            produce(4, 0)
+            self.queue.complete()
+
+        sizes = [[]]
+        for msg in self._drain():
+            if msg == FILE_COMPLETE:
+                sizes.append([])
+            else:
+                sizes[-1].append(len(msg[0]))
+        fast, slow, after, _ = sizes
+
+        # a fast producer grows the chunks, within bounds
+        self.assertEqual(fast[:2], [100, 5050])
+        self.assertEqual(fast[:-1], sorted(fast[:-1]))
+        self.assertTrue(9900 <= max(fast) <= 10000)
+
+        # a slow producer has its chunks placed at the deadline, and
+        # shrinks those which follow
+        self.assertEqual(slow, [100] * 10)
+        self.assertEqual(after, [100, 100])
+
+    def test_empty(self):
+        self.queue.complete()
+        self.assertEqual(self._drain(), [])
+
+
+class QueueTransportTests(unittest.TestCase):
+    def test_backpressure(self):
+        transport = QueueTransport(mp.get_context('spawn'), 10)
+        transport.put([b'abcdefgh'], 1)
+
+        # this would exceed the bound, so waits for the consumer
+        producer = threading.Thread(target=transport.put,
+                                    args=([b'ijklmnop'], 2))
+        producer.start()
+        producer.join(0.2)
+        self.assertTrue(producer.is_alive())
+
+        self.assertEqual(transport.get(), (b'abcdefgh', 1))
+        producer.join()
+        self.assertEqual(transport.get(), (b'ijklmnop', 2))
+
+    def test_oversized(self):
+        # a chunk beyond the bound passes when nothing else is in flight
+        transport = QueueTransport(mp.get_context('spawn'), 4)
+        transport.put([b'abcdefgh'], 1)
+        transport.complete()
+        self.assertEqual(transport.get(), (b'abcdefgh', 1))
+        self.assertEqual(transport.get(), READ_COMPLETE)
+
+    def test_get_many(self):
+        transport = QueueTransport(ThreadContext(), 100)
+        for i in range(3):
+            transport.put([b'abc'], i)
+        transport.complete()
+
+        self.assertEqual(transport.get_many(2), [(b'abc', 0), (b'abc', 1)])
+        self.assertEqual(transport.get_many(5), [(b'abc', 2), READ_COMPLETE])
+        self.assertEqual(transport._in_flight.value, 0)
+
+
+class SharedMemoryTransportTests(unittest.TestCase):
+    def test_ring(self):
+        # fewer slots than chunks, so slots are reused, and one chunk too
+        # large for a slot
+        with mock.patch.object(SharedMemoryTransport, 'SLOTSIZE', 8):
+            transport = SharedMemoryTransport(mp.get_context('spawn'), 24)
+            self.addCleanup(transport.close)
+
+            exp = [(b'abc', 1), (b'defgh', 2), (b'0123456789', 3), (b'', 4),
+                   (b'ij', 5)]
+            obs = []
+            for data, meta in exp:
+                transport.put([data[:2], data[2:]], meta)
+
+                # the consumer keeps up, so the producer never blocks
+                chunk, meta = transport.get()
+                obs.append((bytes(chunk), meta))
+            transport.complete()
+
+            self.assertEqual(obs, exp)
+            self.assertEqual(transport.get(), READ_COMPLETE)
+
+    def test_get_many(self):
+        with mock.patch.object(SharedMemoryTransport, 'SLOTSIZE', 8):
+            transport = SharedMemoryTransport(ThreadContext(), 32)
+            self.addCleanup(transport.close)
+
+            exp = [(b'abc', 1), (b'0123456789', 2), (b'defgh', 3)]
+            for data, meta in exp:
+                transport.put([data], meta)
+            transport.complete()
+
+            # every slotted chunk is held until the next get
+            obs = transport.get_many(10)
+            self.assertEqual([(bytes(c), m) for c, m in obs[:-1]], exp)
+            self.assertEqual(obs[-1], READ_COMPLETE)
+            self.assertEqual(len(transport._views), 2)
+            transport.release()
+            self.assertEqual(transport._views, [])
+
+    def test_bound(self):
+        # the ring is sized to the bound, rather than to whole slots
+        transport = SharedMemoryTransport(ThreadContext(), 1024 * 1024)
+        self.addCleanup(transport.close)
+        self.assertEqual(transport._shm.size, 1024 * 1024)
+
+    def test_oversized(self):
+        with mock.patch.object(SharedMemoryTransport, 'SLOTSIZE', 8):
+            transport = SharedMemoryTransport(ThreadContext(), 16)
+            self.addCleanup(transport.close)
+
+            # a chunk too large for a slot still waits for room
+            transport.put([b'abc'], 1)
+            producer = threading.Thread(
+                target=transport.put, args=([b'0123456789'], 2))
+            producer.start()
+            producer.join(0.1)
+            self.assertTrue(producer.is_alive())
+
+            chunk, meta = transport.get()
+            self.assertEqual((bytes(chunk), meta), (b'abc', 1))
+            chunk, meta = transport.get()
+            self.assertEqual((bytes(chunk), meta), (b'0123456789', 2))
+            producer.join()
+
+
 class ConsolidateTests(unittest.TestCase):
     def setUp(self):
         self.fm_paired = _serialize(fm_paired)
@@ -399,6 +1023,52 @@ class ConsolidateTests(unittest.TestCase):
     def tearDown(self):
         shutil.rmtree(self.clean_up.name)
 
+    def _mux_batches(self):
+        # the multiplexed streams of batches 0 and 1
+        foo_hash = self.foo_hash
+        bar_hash = self.bar_hash
+
+        mux_batch_1 = '\n'.join([f">1.{foo_hash}.0_a/1", "ATGC",
+                                 f">1.{foo_hash}.0_a/2", "ATGCT",
+                                 f">1.{foo_hash}.0_b/1", "TTCC",
+                                 f">1.{foo_hash}.0_b/2", "TTCCT",
+                                 f">1.{foo_hash}.0_c/1", "TTAA",
+                                 f">1.{foo_hash}.0_c/2", "TTAAT",
+                                 f">1.{foo_hash}.0_d/1", "TTTA",
+                                 f">1.{foo_hash}.0_d/2", "TTTAT",
+                                 f">1.{foo_hash}.0_e/1", "TTAT",
+                                 f">1.{foo_hash}.0_e/2", "TTATT",
+                                 f">1.{foo_hash}.0_f/1", "TTGA",
+                                 f">1.{foo_hash}.0_f/2", "TTGAT",
+                                 f">1.{foo_hash}.0_g/1", "TTAC",
+                                 f">1.{foo_hash}.0_g/2", "TTACT",
+                                 f">1.{foo_hash}.0_h/1", "TTCA",
+                                 f">1.{foo_hash}.0_h/2", "TTCAT",
+                                 f">1.{foo_hash}.0_i/1", "TTTT",
+                                 f">1.{foo_hash}.0_i/2", "TTTTT",
+                                 f">1.{foo_hash}.0_j/1", "TTAA",
+                                 f">1.{foo_hash}.0_j/2", "TTAAT",
+                                 f">1.{foo_hash}.0_k/1", "TTA",
+                                 f">1.{foo_hash}.0_k/2", "TTAT",
+                                 f">1.{foo_hash}.0_l/1", "TTC",
+                                 f">1.{foo_hash}.0_l/2", "TTCT",
+                                 f">2.{bar_hash}.0_aa/1", "ATGC",
+                                 f">2.{bar_hash}.0_aa/2", "AATGC",
+                                 f">2.{bar_hash}.0_bb/1", "TTCC",
+                                 f">2.{bar_hash}.0_bb/2", "ATTCC",
+                                 f">2.{bar_hash}.0_cc/1", "TTAA",
+                                 f">2.{bar_hash}.0_cc/2", "ATTAA", ''])
+
+        mux_batch_2 = '\n'.join([f">2.{bar_hash}.1_dd/1", "TTTA",
+                                 f">2.{bar_hash}.1_dd/2", "ATTTA",
+                                 f">2.{bar_hash}.1_ee/1", "TTAT",
+                                 f">2.{bar_hash}.1_ee/2", "ATTAT",
+                                 f">2.{bar_hash}.1_ff/1", "TTGA",
+                                 f">2.{bar_hash}.1_ff/2", "ATTGA",
+                                 f">2.{bar_hash}.1_gg/1", "TTAC",
+                                 f">2.{bar_hash}.1_gg/2", "ATTAC", ''])
+        return mux_batch_1, mux_batch_2
+
     def test_consolidate(self):
         foo_hash = self.foo_hash
         bar_hash = self.bar_hash
@@ -489,6 +1159,86 @@ class ConsolidateTests(unittest.TestCase):
         self.assertEqual(obs_bar_r1, exp_bar_r1)
         self.assertEqual(obs_bar_r2, exp_bar_r2)
 
+    def test_consolidate_threads(self):
+        fm = FileMap.from_tsv(self.fm_paired, 15)
+        for batch, mux in enumerate(self._mux_batches()):
+            dx = Demultiplex(fm, batch, SEPARATE, io.StringIO(mux),
+                             self.clean_up.name, 'fna.gz', engine=THREADS)
+            self.assertTrue(dx.start())
+
+        cx = Consolidate(self.clean_up.name, 'fna.gz', engine=THREADS)
+        self.assertTrue(cx.start())
+
+        for name in ('foo_r1', 'foo_r2', 'bar_r1', 'bar_r2'):
+            with gzip.open(f"{self.clean_up.name}/{name}.fasta.fna.gz",
+                           'rt') as f:
+                obs = f.read()
+            with open(f"{cwd}/test_data/{name}.fasta") as f:
+                self.assertEqual(obs, f.read())
+
+    def test_consolidate_batches(self):
+        # several batches demultiplexed at once still produce partials
+        # per batch
+        bar_hash = self.bar_hash
+
+        fm = FileMap.from_tsv(self.fm_paired, 15)
+        mux = io.StringIO(''.join(self._mux_batches()))
+        dx = Demultiplex(fm, range(0, 2), SEPARATE, mux, self.clean_up.name,
+                         'fna.gz', engine=THREADS)
+        dx.start()
+
+        exp = {'foo_r1.fasta.fna.gz',
+               'foo_r2.fasta.fna.gz',
+               f'dx-partial.2.{bar_hash}.0.bar_r1.fasta.fna.gz',
+               f'dx-partial.2.{bar_hash}.0.bar_r2.fasta.fna.gz',
+               f'dx-partial.2.{bar_hash}.1.bar_r1.fasta.fna.gz',
+               f'dx-partial.2.{bar_hash}.1.bar_r2.fasta.fna.gz'}
+        self.assertEqual(set(os.listdir(self.clean_up.name)), exp)
+
+        Consolidate(self.clean_up.name, 'fna.gz', engine=THREADS).start()
+        for name in ('bar_r1.fasta', 'bar_r2.fasta'):
+            with gzip.open(f"{self.clean_up.name}/{name}.fna.gz", 'rt') as f:
+                obs = f.read()
+            with open(f"{cwd}/test_data/{name}") as f:
+                self.assertEqual(obs, f.read())
+
+    def test_consolidate_partial_extension(self):
+        bar_hash = self.bar_hash
+
+        fm = FileMap.from_tsv(self.fm_paired, 15)
+        for batch, mux in enumerate(self._mux_batches()):
+            dx = Demultiplex(fm, batch, SEPARATE, io.StringIO(mux),
+                             self.clean_up.name, 'fna.xz',
+                             partial_extension='fna.gz',
+                             partial_compression_level=1, transport=SHM)
+            dx.start()
+
+        # partials use their own codec, complete samples the final one
+        exp = {'foo_r1.fasta.fna.xz',
+               'foo_r2.fasta.fna.xz',
+               f'dx-partial.2.{bar_hash}.0.bar_r1.fasta.fna.gz',
+               f'dx-partial.2.{bar_hash}.0.bar_r2.fasta.fna.gz',
+               f'dx-partial.2.{bar_hash}.1.bar_r1.fasta.fna.gz',
+               f'dx-partial.2.{bar_hash}.1.bar_r2.fasta.fna.gz'}
+        obs = set(os.listdir(self.clean_up.name))
+        self.assertEqual(obs, exp)
+
+        cx = Consolidate(self.clean_up.name, 'fna.xz', compression_threads=2,
+                         partial_extension='fna.gz', transport=SHM)
+        cx.start()
+
+        exp |= {'bar_r1.fasta.fna.xz', 'bar_r2.fasta.fna.xz'}
+        obs = set(os.listdir(self.clean_up.name))
+        self.assertEqual(obs, exp)
+
+        for name in ('foo_r1', 'foo_r2', 'bar_r1', 'bar_r2'):
+            with lzma.open(f"{self.clean_up.name}/{name}.fasta.fna.xz",
+                           'rt') as f:
+                obs = f.read()
+            with open(f"{cwd}/test_data/{name}.fasta") as f:
+                exp_data = f.read()
+            self.assertEqual(obs, exp_data)
+
 
 if __name__ == '__main__':
     unittest.main()
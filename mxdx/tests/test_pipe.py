@@ -0,0 +1,104 @@
+import unittest
+import os
+import sys
+import tempfile
+import threading
+from unittest import mock
+
+from mxdx._pipe import (grow_pipe, write_all, is_pipe, pipe_queued,
+                        IdleReader)
+
+
+class PipeTests(unittest.TestCase):
+    def setUp(self):
+        self.r, self.w = os.pipe()
+
+    def tearDown(self):
+        for fd in (self.r, self.w):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def test_is_pipe(self):
+        self.assertTrue(is_pipe(self.r))
+        with tempfile.TemporaryFile() as fp:
+            self.assertFalse(is_pipe(fp.fileno()))
+        self.assertFalse(is_pipe(-1))
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), "linux only")
+    def test_grow_pipe(self):
+        obs = grow_pipe(self.w, 1024 * 1024)
+        self.assertIsNotNone(obs)
+        self.assertTrue(obs >= 65536)
+
+    def test_grow_pipe_ignored(self):
+        self.assertIsNone(grow_pipe(self.w, 0))
+        with tempfile.TemporaryFile() as fp:
+            self.assertIsNone(grow_pipe(fp.fileno(), 1024 * 1024))
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), "linux only")
+    def test_grow_pipe_capped(self):
+        # an unprivileged process falls back to the largest permitted size
+        with mock.patch('mxdx._pipe._pipe_max_size', return_value=131072):
+            obs = grow_pipe(self.w, 1024 * 1024)
+        self.assertEqual(obs, 131072)
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), "linux only")
+    def test_pipe_queued(self):
+        self.assertEqual(pipe_queued(self.w), 0)
+        write_all(self.w, [b'abcd'])
+        self.assertEqual(pipe_queued(self.w), 4)
+        self.assertEqual(pipe_queued(self.r), 4)
+
+    def test_write_all(self):
+        buffers = [b'abc', b'', bytearray(b'defg'), memoryview(b'hij')]
+        write_all(self.w, buffers)
+        os.close(self.w)
+        with os.fdopen(self.r, 'rb') as fp:
+            self.assertEqual(fp.read(), b'abcdefghij')
+
+    def test_write_all_partial(self):
+        # the descriptor accepts a few bytes at a time
+        written = []
+
+        def writev(fd, views):
+            data = b''.join(bytes(v) for v in views)[:3]
+            written.append(data)
+            return len(data)
+
+        with mock.patch('mxdx._pipe.os.writev', side_effect=writev), \
+                mock.patch('mxdx._pipe.IOV_MAX', 2):
+            write_all(self.w, [b'abcd', b'ef', b'ghijk'])
+
+        self.assertEqual(b''.join(written), b'abcdefghijk')
+        self.assertEqual(written, [b'abc', b'def', b'ghi', b'jk'])
+
+    def test_idle_reader(self):
+        idle = []
+        reader = IdleReader(self.r, lambda: idle.append(True),
+                            closefd=False)
+
+        # data are waiting, so there is no call back
+        write_all(self.w, [b'abcd'])
+        self.assertEqual(reader.read(10), b'abcd')
+        self.assertEqual(idle, [])
+
+        # nothing is waiting, so we call back before the read blocks
+        writer = threading.Timer(0.05, write_all, args=(self.w, [b'efg']))
+        writer.start()
+        self.assertEqual(reader.read(10), b'efg')
+        writer.join()
+        self.assertEqual(len(idle), 1)
+
+        os.close(self.w)
+        self.assertEqual(reader.read(10), b'')
+        reader.close()
+        self.assertTrue(reader.closed)
+
+        # the descriptor is left open
+        os.fstat(self.r)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+import unittest
+import io
+import os
+import sys
+import signal
+import shutil
+import tempfile
+
+from unittest import mock
+
+from mxdx._run import Run
+from mxdx._mxdx import ChunkedQueue
+from mxdx._io import FileMap
+from mxdx._constants import (INTERLEAVE, THREADS, PROCESSES, FORK, SHM, MUX,
+                             TOOL, DEMUX, ROUND_ROBIN, LOAD)
+
+
+def _serialize(data):
+    return io.StringIO('\n'.join(['\t'.join(v) for v in data]) + '\n')
+
+
+def _records(data):
+    return sorted('>' + record for record in data.split('>')[1:])
+
+
+def _ids(data):
+    return [line[1:-2] for line in data.splitlines() if line.startswith('>')]
+
+
+cwd = os.path.dirname(__file__)
+fm_paired = [["filename_1", "filename_2", "record_count"],
+             [f"{cwd}/test_data/foo_r1.fasta",
+              f"{cwd}/test_data/foo_r2.fasta", "12"],
+             [f"{cwd}/test_data/bar_r1.fasta",
+              f"{cwd}/test_data/bar_r2.fasta", "7"]]
+
+
+class RunTests(unittest.TestCase):
+    def setUp(self):
+        self.fm = FileMap.from_tsv(_serialize(fm_paired), 100)
+        self.output_base = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_base)
+
+    def _assert_round_trip(self):
+        for name in ('foo_r1', 'foo_r2', 'bar_r1', 'bar_r2'):
+            with open(f"{self.output_base}/{name}.fasta.fna") as obs, \
+                    open(f"{cwd}/test_data/{name}.fasta") as exp:
+                self.assertEqual(obs.read(), exp.read())
+
+    def test_run(self):
+        for engine, kwargs in ((THREADS, {}),
+                               (PROCESSES, {'transport': SHM})):
+            rx = Run(self.fm, 0, ['cat'], self.output_base, 'fna',
+                     mux_paired_handling=INTERLEAVE, engine=engine,
+                     **kwargs)
+            obs = rx.start()
+            self._assert_round_trip()
+
+            self.assertIs(obs, rx.metrics)
+            (tool, ) = obs[TOOL]
+            self.assertEqual(tool['returncode'], 0)
+            for stage in (obs[MUX], tool, obs[DEMUX]):
+                self.assertTrue(stage['completed'])
+                self.assertTrue(stage['seconds'] >= 0)
+
+            # the tags are stripped on the way out
+            self.assertTrue(obs[MUX]['nbytes'] > obs[DEMUX]['nbytes'] > 0)
+
+    def test_run_tool_fails(self):
+        rx = Run(self.fm, 0, [sys.executable, '-c', 'exit(3)'],
+                 self.output_base, 'fna', engine=THREADS)
+        with self.assertRaisesRegex(RuntimeError, TOOL):
+            rx.start()
+        self.assertEqual(rx.metrics[TOOL][0]['returncode'], 3)
+        self.assertFalse(rx.metrics[TOOL][0]['completed'])
+
+    def test_run_tool_missing(self):
+        rx = Run(self.fm, 0, [f"{self.output_base}/nosuchtool"],
+                 self.output_base, 'fna', mux_paired_handling=INTERLEAVE,
+                 engine=THREADS, shards=2)
+        with self.assertRaisesRegex(RuntimeError, "failed to start") as cm:
+            rx.start()
+        self.assertIsInstance(cm.exception.__cause__, FileNotFoundError)
+
+    def test_run_shards(self):
+        for distribution in (ROUND_ROBIN, LOAD, ROUND_ROBIN, LOAD):
+            # small chunks, so each shard sees some of the records, and so
+            # the mates of a pair could land in separate chunks on the way
+            # back
+            with mock.patch.object(ChunkedQueue, 'CHUNKSIZE', 20), \
+                    mock.patch.object(ChunkedQueue, 'MINCHUNKSIZE', 20):
+                rx = Run(self.fm, 0, ['cat'], self.output_base, 'fna',
+                         mux_paired_handling=INTERLEAVE, engine=THREADS,
+                         shards=3, distribution=distribution)
+                rx.start()
+
+            tools = rx.metrics[TOOL]
+            self.assertEqual(len(tools), 3)
+            self.assertTrue(all(tool['completed'] for tool in tools))
+
+            # records are interleaved across shards, but are all present
+            for name in ('foo_r1', 'foo_r2', 'bar_r1', 'bar_r2'):
+                with open(f"{self.output_base}/{name}.fasta.fna") as obs, \
+                        open(f"{cwd}/test_data/{name}.fasta") as exp:
+                    self.assertEqual(_records(obs.read()),
+                                     _records(exp.read()))
+
+            # the records of a shard interleave with those of the others,
+            # but R1 and R2 must remain in the same order
+            for name in ('foo', 'bar'):
+                with open(f"{self.output_base}/{name}_r1.fasta.fna") as r1, \
+                        open(f"{self.output_base}/{name}_r2.fasta.fna") as r2:
+                    self.assertEqual(_ids(r1.read()), _ids(r2.read()))
+
+    def test_run_shard_fails(self):
+        rx = Run(self.fm, 0, [sys.executable, '-c', 'exit(3)'],
+                 self.output_base, 'fna', mux_paired_handling=INTERLEAVE,
+                 engine=THREADS, shards=2)
+        with self.assertRaisesRegex(RuntimeError, r'tool\.\d, tool\.\d'):
+            rx.start()
+
+        # the shard which fails second may already have been stopped
+        returncodes = sorted(tool['returncode'] for tool in rx.metrics[TOOL])
+        self.assertIn(returncodes, ([3, 3], [-signal.SIGTERM, 3]))
+
+    def test_run_empty_output(self):
+        # a tool can succeed with nothing to report
+        rx = Run(self.fm, 0, [sys.executable, '-c',
+                              'import sys; sys.stdin.read()'],
+                 self.output_base, 'fna', engine=THREADS)
+        rx.start()
+        self.assertEqual(rx.metrics[DEMUX]['nbytes'], 0)
+        self.assertEqual(os.listdir(self.output_base), [])
+
+    @unittest.skipUnless(os.path.isdir('/proc/self/fd'), "needs /proc")
+    def test_run_pipes(self):
+        # pipes are only made, and closed again, by start
+        fds = set(os.listdir('/proc/self/fd'))
+        rx = Run(self.fm, 0, ['cat'], self.output_base, 'fna',
+                 mux_paired_handling=INTERLEAVE, engine=THREADS, shards=2)
+        self.assertEqual(set(os.listdir('/proc/self/fd')), fds)
+        rx.start()
+        self.assertEqual(set(os.listdir('/proc/self/fd')), fds)
+
+    def test_run_invalid(self):
+        with self.assertRaises(ValueError):
+            Run(self.fm, 0, [], self.output_base, 'fna')
+        with self.assertRaises(ValueError):
+            Run(self.fm, 0, ['cat'], self.output_base, 'fna',
+                start_method=FORK)
+        with self.assertRaises(ValueError):
+            Run(self.fm, 0, ['cat'], self.output_base, 'fna',
+                engine='steam')
+        with self.assertRaises(ValueError):
+            Run(self.fm, 0, ['cat'], self.output_base, 'fna', shards=0)
+        with self.assertRaises(ValueError):
+            Run(self.fm, 0, ['cat'], self.output_base, 'fna', shards=2,
+                mux_paired_handling=INTERLEAVE, distribution='random')
+        with self.assertRaises(ValueError):
+            Run(self.fm, 0, ['cat'], self.output_base, 'fna', shards=2)
+
+
+if __name__ == '__main__':
+    unittest.main()
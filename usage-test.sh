@@ -52,3 +52,81 @@ if [[ ${obs_bar} != ${exp_bar} ]]; then
     echo ${exp_bar}
     exit 1
 fi
+
+# several batches through one invocation
+mxdx mux \
+    --file-map usage-test-files.tsv \
+    --batches 0-1 \
+    --batch-size 15 | \
+        mxdx demux \
+            --file-map usage-test-files.tsv \
+            --batches 0-1 \
+            --batch-size 15 \
+            --output-base usage-test/batches \
+            --extension fna.gz
+mxdx consolidate-partials \
+    --output-base usage-test/batches \
+    --extension fna.gz
+
+obs_foo=$(${zcat} usage-test/batches/foo_r1.fasta.fna.gz | ${md5})
+obs_bar=$(${zcat} usage-test/batches/bar_r1.fasta.fna.gz | ${md5})
+if [[ ${obs_foo} != ${exp_foo} ]]; then
+    echo ${obs_foo}
+    echo ${exp_foo}
+    exit 1
+fi
+if [[ ${obs_bar} != ${exp_bar} ]]; then
+    echo ${obs_bar}
+    echo ${exp_bar}
+    exit 1
+fi
+
+# mux, a tool and demux in one command
+for batch in 0 1; do
+    mxdx run \
+        --file-map usage-test-files.tsv \
+        --batch ${batch} \
+        --batch-size 15 \
+        --output-base usage-test/run \
+        --extension fna.gz \
+        -- cat
+done
+mxdx consolidate-partials \
+    --output-base usage-test/run \
+    --extension fna.gz
+
+obs_foo=$(${zcat} usage-test/run/foo_r1.fasta.fna.gz | ${md5})
+obs_bar=$(${zcat} usage-test/run/bar_r1.fasta.fna.gz | ${md5})
+if [[ ${obs_foo} != ${exp_foo} ]]; then
+    echo ${obs_foo}
+    echo ${exp_foo}
+    exit 1
+fi
+if [[ ${obs_bar} != ${exp_bar} ]]; then
+    echo ${obs_bar}
+    echo ${exp_bar}
+    exit 1
+fi
+
+# a tool run as several shards, whose records may come back in any order
+for batch in 0 1; do
+    mxdx run \
+        --file-map usage-test-files.tsv \
+        --batch ${batch} \
+        --batch-size 15 \
+        --output-base usage-test/shards \
+        --extension fna.gz \
+        --shards 2 \
+        -- cat
+done
+mxdx consolidate-partials \
+    --output-base usage-test/shards \
+    --extension fna.gz
+
+exp_foo=$(${zcat} usage-test/foo_r1.fasta.fna.gz | paste - - | sort | ${md5})
+obs_foo=$(${zcat} usage-test/shards/foo_r1.fasta.fna.gz | paste - - | sort | ${md5})
+if [[ ${obs_foo} != ${exp_foo} ]]; then
+    echo ${obs_foo}
+    echo ${exp_foo}
+    exit 1
+fi